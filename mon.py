@@ -1,23 +1,44 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import re
+import errno
 import sys
+import fcntl
+import heapq
 import optparse
+import termios
 import time
 import signal
+import struct
+from array import array
+from cStringIO import StringIO
 from datetime import timedelta
 
+try:
+   import numpy
+except ImportError:
+   numpy = None
+
+try:
+   from os import scandir
+except ImportError:
+   try:
+      from scandir import scandir
+   except ImportError:
+      scandir = None
+
 """
    A system monitoring program for terminals.  Monitors:
       power usage
       cpu usage
       mem usage
+      network and disk i/o
       temperature
 
    @TODO:
-      monitor networking usage
       remove hardcoded file names
-      use signals or threads instead of sleep
       use classes?
 """
 __author__  = "Neil (mace033@gmail.com)"
@@ -27,6 +48,44 @@ __license__ = "GPLv2"
 TITLE_WIDTH = 17
 CHART_WIDTH = 30
 
+# /proc/stat cpu columns, guest time is already counted in user and nice
+CPU_STATES = ('user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq',
+   'steal')
+CPU_LABELS = ('us', 'ni', 'sy', 'id', 'wa', 'hi', 'si', 'st')
+IDLE, IOWAIT = 3, 4
+# above this many cores --cpu-view auto draws a heatmap instead of bars
+HEATMAP_CPUS = 16
+HEAT_CHARS = ' .:-=+*#%@'
+
+# /proc/net/dev columns: rx bytes, rx packets, tx bytes, tx packets
+NET_COLS = (0, 1, 8, 9)
+# /proc/diskstats columns: reads, sectors read, ms reading, writes,
+# sectors written, ms writing, ms doing i/o
+DISK_COLS = (0, 2, 3, 4, 6, 7, 9)
+SECTOR_SIZE = 512
+
+# collectors in sampling order, and the intervals that do not follow
+# --seconds, 0 samples once at startup
+COLLECTORS = ('cpuinfo', 'battery', 'temperature', 'loadavg', 'cpu', 'mem',
+   'net', 'disk', 'procs')
+DEFAULT_INTERVALS = {'cpuinfo': 0, 'battery': 30}
+
+# --record files: a header with the number of cpus, then fixed-width
+# little-endian samples of time, load averages, temperature, battery %,
+# total/free mem and swap KB, cpu state % and the busy % of every cpu.
+# Missing temperatures and batteries are NaN.
+RECORD_MAGIC = 'monrec01'
+RECORD_HEADER = struct.Struct('<8sI')
+RECORD_COLLECTORS = ('battery', 'temperature', 'loadavg', 'cpu', 'mem')
+RECORD_FLUSH_SECS = 5.0
+NAN = float('nan')
+
+# color escapes, the only ones the print_* functions emit
+SGR = re.compile(u'(\x1b\\[[0-9;]*m)')
+# changed cells closer than this are redrawn as one run, cheaper than
+# moving the cursor
+RUN_GAP = 8
+
 class TermColors:
    PURPLE = '\033[95m'
    BLUE = '\033[94m'
@@ -45,14 +104,50 @@ class TermColors:
       self.DEFAULT = ''
       self.CLEAR_SCREEN = ''
 
-def get_stats(ifn):
+class ProcFile:
+   '''A /proc or /sys file that is opened once and re-read from the start
+   into the same buffer on every sample, instead of being reopened.'''
+
+   def __init__(self, fn, size=4096):
+      self.fn = fn
+      self.buf = bytearray(size)
+      try:
+         self.f = open(fn, 'rb', 0)
+      except IOError:
+         self.f = None
+
+   def read(self):
+      '''Returns the current contents, or '' if the file is missing'''
+      if self.f is None:
+         return ''
+      n = 0
+      try:
+         self.f.seek(0)
+         while True:
+            if n == len(self.buf):
+               # grow the buffer once, later samples reuse it
+               self.buf.extend(bytearray(len(self.buf)))
+            got = self.f.readinto(memoryview(self.buf)[n:])
+            if not got:
+               break
+            n += got
+      except IOError:
+         return ''
+      return str(self.buf[:n])
+
+proc_files = dict()
+
+def proc_file(fn):
+   '''Returns the ProcFile for fn, opening it on first use'''
    try:
-      ilines = open(ifn, 'r').readlines()
-   except IOError:
-      return {}
+      return proc_files[fn]
+   except KeyError:
+      pf = proc_files[fn] = ProcFile(fn)
+      return pf
 
+def get_stats(ifn):
    info_dict = dict()
-   for l in ilines:
+   for l in proc_file(ifn).read().splitlines():
        if not l:
          continue
        tmp = l.strip().split(":")
@@ -66,10 +161,146 @@ def get_stats(ifn):
 def dump_stats_dict(d):
    print '\n'.join([str(k) + ": " + str(v) for k,v in d.items()])
 
-def do_every(secs, func, *args):
+try:
+   monotonic = time.monotonic
+except AttributeError:
+   def monotonic():
+      # elapsed time from times(2), clock ticks since boot
+      return os.times()[4]
+
+class Scheduler:
+   '''Runs collectors on monotonic deadlines.  A collector's next deadline
+   is its previous deadline plus its interval, not the time it finished,
+   so slow collection or drawing does not add up to drift.  Deadlines a
+   collector fell a whole interval behind on are skipped and counted as
+   missed.  A one-shot interval timer, re-armed for the earliest deadline
+   after every wakeup, fires SIGALRM to wake the loop.'''
+
+   def __init__(self):
+      self.collectors = list()
+      self.samples = dict()
+      self.missed = dict()
+
+   def add(self, name, interval, func):
+      '''interval 0 runs func once, at startup'''
+      self.collectors.append([name, interval, func, None])
+
+   def run_due(self, now):
+      '''Runs the collectors that are due, returns their names'''
+      ran = list()
+      for c in self.collectors:
+         name, interval, func, deadline = c
+         if deadline is None:
+            deadline = now
+         elif not interval or deadline > now:
+            continue
+         self.samples[name] = func()
+         ran.append(name)
+
+         late = 0
+         if interval:
+            late = int((now - deadline) / interval)
+         if late > 0:
+            self.missed[name] = self.missed.get(name, 0) + late
+         c[3] = deadline + (late + 1) * interval
+      return ran
+
+   def run(self, func):
+      '''Calls func with the names of the collectors that ran, after
+      every wakeup that ran any'''
+      periodic = [c for c in self.collectors if c[1]]
+      if not periodic:
+         func(self.run_due(monotonic()))
+         return
+
+      # the alarm also writes a byte to this pipe, so one that fires
+      # before we start waiting on it still wakes us
+      wake_r, wake_w = os.pipe()
+      fcntl.fcntl(wake_w, fcntl.F_SETFL,
+         fcntl.fcntl(wake_w, fcntl.F_GETFL) | os.O_NONBLOCK)
+      signal.set_wakeup_fd(wake_w)
+      signal.signal(signal.SIGALRM, lambda signum, frame: None)
+      # restart reads and writes the alarm lands in instead of failing
+      # them with EINTR
+      signal.siginterrupt(signal.SIGALRM, False)
+      while True:
+         ran = self.run_due(monotonic())
+         if ran:
+            func(ran)
+         delay = min(c[3] for c in periodic) - monotonic()
+         if delay > 0:
+            signal.setitimer(signal.ITIMER_REAL, delay)
+            os.read(wake_r, 64)
+
+class CounterTable:
+   '''The previous and current sample of a table of ever increasing
+   counters, one row per name (cpu0, eth0, sda) and one column per counter.
+   Both samples live in buffers allocated once and swapped on every update:
+   2-d numpy arrays when numpy is available, flat arrays otherwise.'''
+
+   def __init__(self, ncols):
+      self.ncols = ncols
+      self.names = None
+
+   def alloc(self, nrows):
+      if numpy:
+         return numpy.zeros((nrows, self.ncols))
+      return array('d', [0.0]) * (nrows * self.ncols)
+
+   def update(self, names, values):
+      '''Stores a sample of len(names) * ncols counters, given row by row,
+      and returns the deltas since the previous sample as rows of columns.
+      The first sample, and the first after the rows changed, is
+      compared against zero, ie. the counters since boot.  elapsed is
+      set to the seconds the deltas cover.'''
+      now = time.time()
+      if names != self.names:
+         self.names = names
+         self.prev = self.alloc(len(names))
+         self.curr = self.alloc(len(names))
+         self.stamp = now - get_uptime()
+      self.elapsed = max(now - self.stamp, 1e-3)
+      self.stamp = now
+      if numpy:
+         self.curr.flat[:] = values
+         deltas = self.curr - self.prev
+      else:
+         self.curr[:] = array('d', map(float, values))
+         prev, curr, n = self.prev, self.curr, self.ncols
+         deltas = [[curr[i] - prev[i] for i in xrange(r, r + n)]
+            for r in xrange(0, len(curr), n)]
+      self.prev, self.curr = self.curr, self.prev
+      return deltas
+
+def get_uptime(ifn = "/proc/uptime"):
+   try:
+      return float(proc_file(ifn).read().split()[0])
+   except (IndexError, ValueError):
+      return 1.0
+
+def get_counter_stats(ifn, parse, ncols):
+   '''Yields the names, the deltas and the seconds they cover of the
+   counter table parse() pulls out of ifn on every sample'''
+   src = proc_file(ifn)
+   table = CounterTable(ncols)
    while True:
-      func(*args)
-      time.sleep(secs)
+      names, values = parse(src.read())
+      yield {'names': names, 'deltas': table.update(names, values),
+         'elapsed': table.elapsed}
+
+def format_bytes(n):
+   for unit in ('B', 'KB', 'MB', 'GB'):
+      if n < 1024:
+         break
+      n /= 1024.0
+   return "%.1f%s" % (n, unit)
+
+# highest rate seen per chart, the charts of unbounded rates scale to it
+rate_peaks = dict()
+
+def get_peak(key, rate):
+   peak = rate_peaks[key] = max(rate_peaks.get(key, 0), rate)
+   return peak
 
 def get_chart(curr, max=None):
    CHART_WIDTH
@@ -135,16 +366,17 @@ def print_battery_stats(info_dict, verbose):
       get_chart(pct_age, 100), pct_age)
 
 def get_mem_stats(ifn = "/proc/meminfo"):
-   slines = open(ifn, 'r').readlines()
-
    stats_dict = dict()
-   for l in slines:
+   for l in proc_file(ifn).read().splitlines():
        tmp = l.strip().split(":")
        stats_dict[tmp[0].strip()] = tmp[1].lstrip()
 
    return stats_dict
 
 def print_mem_stats(stats_dict, verbose=False):
+   if not stats_dict:
+      return
+
    if verbose:
       dump_stats_dict(stats_dict)
    mem_total = int(stats_dict['MemTotal'].strip("kB")) / 1024
@@ -157,48 +389,234 @@ def print_mem_stats(stats_dict, verbose=False):
    print_pct("%s %s %d / %dMB", "Free swap:".ljust(TITLE_WIDTH),
       get_chart(swap_free, swap_total), swap_free, swap_total)
 
+def get_stat_field(text, key):
+   i = text.find('\n' + key + ' ')
+   if i < 0:
+      return 0
+   return int(text[i + len(key) + 2:text.find('\n', i + 1)])
+
 def get_cpu_stats(ifn = "/proc/stat"):
-   last_stats_dict = None
+   src = proc_file(ifn)
+   table = CounterTable(len(CPU_STATES))
    while True:
-      slines = open(ifn, 'r').readlines()
-      stats_type_list = ['procs_running', 'procs_blocked',]
-      stats_dict = dict()
-
-      for l in slines:
+      text = src.read()
+      # the cpu rows come first, in cpu number order, skip the long
+      # intr and softirq rows that follow them
+      end = text.find('\n', text.rfind('\ncpu') + 1)
+      names = list()
+      values = list()
+      for l in text[:end].split('\n'):
          stats = l.split()
-         stat_type = stats.pop(0)
-         if l.startswith('cpu'):
-            # cpu usage
-            total_usage = long(stats[0]) + long(stats[1]) + long(stats[2])
-            total = long(stats[0]) + long(stats[1]) + long(stats[2]) + long(stats[3])
-            if last_stats_dict:
-               last_stats = last_stats_dict[stat_type]
-               stats_dict[stat_type] = ((total_usage, total), last_stats[0])
-            else:
-               stats_dict[stat_type] = ((total_usage, total), (0, 0))
-         else:
-            # other stats
-            if stat_type in stats_type_list:
-               stats_dict[stat_type] = int(stats[0])
+         names.append(stats[0])
+         values.extend(stats[1:len(CPU_STATES) + 1])
+         # older kernels lack the iowait, irq and steal columns
+         values.extend('0' * (len(CPU_STATES) + 1 - len(stats)))
 
-      yield stats_dict
-      last_stats_dict = stats_dict
+      yield {'names': tuple(names),
+         'deltas': table.update(tuple(names), values),
+         'procs_running': get_stat_field(text, 'procs_running'),
+         'procs_blocked': get_stat_field(text, 'procs_blocked')}
 
-def print_cpu_stats(stats_dict, verbose=False):
+def get_cpu_pcts(deltas):
+   '''Share of each state in each cpu's ticks, and the busy share (all
+   but idle and iowait) of each cpu'''
+   if numpy:
+      total = deltas.sum(axis=1)
+      total[total == 0] = 1
+      pcts = deltas * 100.0 / total[:, numpy.newaxis]
+      return pcts, pcts.sum(axis=1) - pcts[:, IDLE] - pcts[:, IOWAIT]
+   pcts = list()
+   for row in deltas:
+      total = sum(row) or 1
+      pcts.append([v * 100.0 / total for v in row])
+   return pcts, [sum(p) - p[IDLE] - p[IOWAIT] for p in pcts]
+
+def print_cpu_heatmap(names, busy):
+   # one cell per cpu, CHART_WIDTH cpus per line
+   for i in xrange(0, len(names), CHART_WIDTH):
+      cells = list()
+      color = None
+      for v in busy[i:i + CHART_WIDTH]:
+         if v < 50:
+            c = TermColors.GREEN
+         elif v < 80:
+            c = TermColors.YELLOW
+         else:
+            c = TermColors.RED
+         if c != color:
+            cells.append(c)
+            color = c
+         cells.append(HEAT_CHARS[max(0, min(int(v / 10), 9))])
+      last = names[min(i + CHART_WIDTH, len(names)) - 1]
+      print_pct("%s [%s%s]", ("%s-%s:" % (names[i], last[3:])).ljust(TITLE_WIDTH),
+         ''.join(cells), TermColors.YELLOW)
+
+def print_cpu_stats(stats_dict, verbose=False, view='auto'):
+   names = stats_dict['names']
+   pcts, busy = get_cpu_pcts(stats_dict['deltas'])
    if verbose:
-      dump_stats_dict(stats_dict)
-   for k,v in stats_dict.items():
-      if k.startswith('cpu'):
-         curr = stats_dict[k][0]
-         prev = stats_dict[k][1]
-         usage = curr[0] - prev[0]
-         total = curr[1] - prev[1]
+      for name, p in zip(names, pcts):
+         print "%s: %s" % (name, ' '.join("%s %.1f" % (s, v)
+            for s, v in zip(CPU_STATES, p)))
+      print "procs_running: %d procs_blocked: %d" % (
+         stats_dict['procs_running'], stats_dict['procs_blocked'])
+
+   # the first row sums up every cpu
+   print_pct("%s %s %d%%", (names[0] + " usage:").ljust(TITLE_WIDTH),
+      get_chart(busy[0], 100), busy[0])
+   print_pct("%s %s", "".ljust(TITLE_WIDTH), ' '.join("%s %.1f%%" % (l, v)
+      for l, v in zip(CPU_LABELS, pcts[0]) if l != 'id'))
+
+   cores = len(names) - 1
+   if view == 'auto':
+      view = cores > HEATMAP_CPUS and 'heatmap' or 'bars'
+   if view == 'heatmap':
+      print_cpu_heatmap(names[1:], busy[1:])
+   elif view == 'bars':
+      for i in xrange(1, len(names)):
+         print_pct("%s %s %d%%", (names[i] + " usage:").ljust(TITLE_WIDTH),
+            get_chart(busy[i], 100), busy[i])
+
+def parse_net_dev(text):
+   names = list()
+   values = list()
+   # skip the two header lines
+   for l in text.split('\n')[2:]:
+      name, sep, stats = l.partition(':')
+      if not sep:
+         continue
+      stats = stats.split()
+      names.append(name.strip())
+      values.extend([stats[i] for i in NET_COLS])
+   return tuple(names), values
+
+def get_net_stats(ifn = "/proc/net/dev"):
+   return get_counter_stats(ifn, parse_net_dev, len(NET_COLS))
+
+def print_net_stats(stats_dict, verbose=False):
+   elapsed = stats_dict['elapsed']
+   for name, d in zip(stats_dict['names'], stats_dict['deltas']):
+      if verbose:
+         print "%s: rx %d bytes %d packets tx %d bytes %d packets in %.2fs" % (
+            name, d[0], d[1], d[2], d[3], elapsed)
+      for title, nbytes, packets in (('rx', d[0], d[1]), ('tx', d[2], d[3])):
+         rate = nbytes / elapsed
+         print_pct("%s %s %s/s %d pkt/s", ("%s %s:" % (name, title)).ljust(TITLE_WIDTH),
+            get_chart(rate, get_peak((name, title), rate)), format_bytes(rate),
+            packets / elapsed)
+
+disk_names = dict()
+
+def is_disk(name):
+   '''Whole disks only, not partitions or loop and ram devices'''
+   try:
+      return disk_names[name]
+   except KeyError:
+      if name.startswith(('loop', 'ram')):
+         disk = False
+      elif os.path.isdir("/sys/block"):
+         disk = os.path.exists("/sys/block/" + name.replace('/', '!'))
+      else:
+         disk = True
+      disk_names[name] = disk
+      return disk
+
+def parse_diskstats(text):
+   names = list()
+   values = list()
+   for l in text.split('\n'):
+      stats = l.split()
+      if len(stats) < 14 or not is_disk(stats[2]):
+         continue
+      names.append(stats[2])
+      values.extend([stats[3 + i] for i in DISK_COLS])
+   return tuple(names), values
+
+def get_disk_stats(ifn = "/proc/diskstats"):
+   return get_counter_stats(ifn, parse_diskstats, len(DISK_COLS))
+
+def print_disk_stats(stats_dict, verbose=False):
+   elapsed = stats_dict['elapsed']
+   for name, d in zip(stats_dict['names'], stats_dict['deltas']):
+      if verbose:
+         print "%s: %s in %.2fs" % (name, ' '.join("%d" % (v,) for v in d),
+            elapsed)
+      ios = d[0] + d[3]
+      # ms doing i/o per ms elapsed
+      util = min(d[6] / (elapsed * 10.0), 100.0)
+      if ios:
+         await_ms = (d[2] + d[5]) / ios
+      else:
+         await_ms = 0.0
+      print_pct("%s %s %d%% %d IOPS %s/s await %.1fms",
+         (name + " util:").ljust(TITLE_WIDTH), get_chart(util, 100), util,
+         ios / elapsed, format_bytes((d[1] + d[4]) * SECTOR_SIZE / elapsed),
+         await_ms)
+
+def get_pids(path = "/proc"):
+   if scandir:
+      names = [e.name for e in scandir(path)]
+   else:
+      names = os.listdir(path)
+   return [int(n) for n in names if n.isdigit()]
+
+def get_process_stats(path = "/proc"):
+   '''Yields the cpu %, RSS in KB, pid and name of every process.  The
+   cpu time of each process at the previous scan is kept keyed by
+   (pid, start time), so a reused pid starts over, together with the
+   name, which is only parsed once per process.  A process seen for the
+   first time is measured since it started.'''
+   hz = float(os.sysconf('SC_CLK_TCK'))
+   page_kb = os.sysconf('SC_PAGE_SIZE') / 1024
+   prev = dict()
+   prev_now = 0
+   while True:
+      # clock ticks since boot, the unit of the start times
+      now = get_uptime() * hz
+      seen = dict()
+      procs = list()
+      for pid in get_pids(path):
+         try:
+            fd = os.open("%s/%d/stat" % (path, pid), os.O_RDONLY)
+            try:
+               buf = os.read(fd, 1024)
+            finally:
+               os.close(fd)
+         except OSError:
+            # exited since the listing
+            continue
+
+         # the name may hold spaces and parens, the fields follow the
+         # last paren starting with field 3, state
+         i = buf.rfind(')')
+         fields = buf[i + 2:].split(None, 22)
+         ticks = int(fields[11]) + int(fields[12])
+         key = (pid, fields[19])
          try:
-            usage_pct = float(usage)/total * 100
-         except ZeroDivisionError:
-            usage_pct = 0
-         print_pct("%s %s %d%%", (k + " usage:").ljust(TITLE_WIDTH),
-            get_chart(usage_pct, 100), usage_pct)
+            last_ticks, name = prev[key]
+            since = prev_now
+         except KeyError:
+            last_ticks, name = 0, buf[buf.find('(') + 1:i]
+            since = int(fields[19])
+         seen[key] = (ticks, name)
+         procs.append(((ticks - last_ticks) * 100.0 / max(now - since, 1),
+            int(fields[21]) * page_kb, pid, name))
+
+      prev = seen
+      prev_now = now
+      yield {'procs': procs}
+
+def print_process_stats(stats_dict, verbose=False, top=10, sort='cpu'):
+   procs = stats_dict['procs']
+   if sort == 'rss':
+      procs = heapq.nlargest(top, procs, key=lambda p: p[1])
+   else:
+      procs = heapq.nlargest(top, procs)
+   print "%s[Top %d of %d processes by %s]%s" % (TermColors.BLUE,
+      len(procs), len(stats_dict['procs']), sort, TermColors.DEFAULT)
+   for cpu, rss_kb, pid, name in procs:
+      print_pct("%s %s %5.1f%% %8s pid %d", (name[:TITLE_WIDTH - 1] + ":").ljust(TITLE_WIDTH),
+         get_chart(min(cpu, 100), 100), cpu, format_bytes(rss_kb * 1024.0), pid)
 
 def print_header():
    print "%s[%s]%s" % (TermColors.BLUE,
@@ -248,50 +666,380 @@ def print_proc_info(cpu_info_dict, verbose):
       cpu_info_dict['loadavg'], normalized_loadavg, 
       cpu_info_dict.get('temperature', 'n/a'), TermColors.DEFAULT)
 
-def print_stats(verbose=False, cpu_stats_gen=get_cpu_stats()):
+def get_battery_stats():
    batt_info_dict = get_stats("/proc/acpi/battery/BAT0/info")
    batt_info_dict.update(get_stats("/proc/acpi/battery/BAT0/state"))
 
    # HACK: handle present rate = unknown
    if batt_info_dict.get('present rate', 'unknown') == 'unknown':
       batt_info_dict['present rate'] = '1250 mAh'
+   return batt_info_dict
 
-   cpu_info_dict = get_stats("/proc/cpuinfo")
+def get_temperature():
    #cpu_info_dict.update(get_stats("/proc/acpi/thermal_zone/THRM/temperature"))
 
    # HACK: get temp from libsensor (ie. libsensor is a dependency)
    fn_list = ["/sys/class/hwmon/hwmon0/device/hwmon/hwmon0/device/temp1_input"]
    temp_list = list()
    for fn in fn_list:
-      cpu_info_dict.update(get_stats(fn))
       try:
-         temp = '%.0f°C' % (int(cpu_info_dict['temp'])/(1000.0))
-         del cpu_info_dict['temp']
-      except ValueError:
+         temp = '%.0f°C' % (int(get_stats(fn)['temp'])/(1000.0))
+      except (KeyError, ValueError):
          temp = 'n/a'
       temp_list.append(temp)
-   cpu_info_dict['temperature'] = ' '.join("%s" % (s,) for s in temp_list)
+   return ' '.join("%s" % (s,) for s in temp_list)
 
+def get_loadavg():
+   load_avg = ' '.join(proc_file("/proc/loadavg").read().split()[:3])
+   if not load_avg:
+      load_avg = "n/a n/a n/a"
+   return load_avg
+
+def get_collectors():
+   '''Maps each of COLLECTORS to the function taking its sample'''
+   return {'cpuinfo': lambda: get_stats("/proc/cpuinfo"),
+      'battery': get_battery_stats,
+      'temperature': get_temperature,
+      'loadavg': get_loadavg,
+      'cpu': get_cpu_stats().next,
+      'mem': get_mem_stats,
+      'net': get_net_stats().next,
+      'disk': get_disk_stats().next,
+      'procs': get_process_stats().next}
+
+def get_intervals(specs, secs):
+   '''Applies NAME=SECS specs over the default collector intervals'''
+   intervals = dict((name, DEFAULT_INTERVALS.get(name, secs))
+      for name in COLLECTORS)
+   for spec in specs or []:
+      name, sep, value = spec.partition('=')
+      if name not in intervals or not sep:
+         raise ValueError("bad interval %s, expected NAME=SECS with NAME "
+            "one of %s" % (spec, ', '.join(COLLECTORS)))
+      intervals[name] = float(value)
+   return intervals
+
+def get_term_size(fd):
+   '''(rows, columns) of the terminal on fd, None if it is not one'''
    try:
-      load_avg = ' '.join(open("/proc/loadavg", 'r').readlines()[0].split()[:3])
+      rows, cols = struct.unpack('hh', fcntl.ioctl(fd, termios.TIOCGWINSZ,
+         '\0' * 4))
    except IOError:
-      load_avg = "n/a n/a n/a"
-   cpu_info_dict['loadavg'] = load_avg
+      return None
+   return rows or None, cols or None
+
+def get_cells(line):
+   '''Splits a line into (character, color escape) cells'''
+   cells = list()
+   attr = u''
+   for part in SGR.split(line.decode('utf-8', 'replace')):
+      if part.startswith(u'\x1b['):
+         attr = part
+      else:
+         cells.extend([(c, attr) for c in part])
+   return cells
+
+def get_changed_runs(old, new):
+   '''Yields the [start, end) runs of the cells in new that differ from
+   old, merging runs less than RUN_GAP cells apart'''
+   run = None
+   for i, cell in enumerate(new):
+      if i < len(old) and old[i] == cell:
+         continue
+      if run and i - run[1] < RUN_GAP:
+         run[1] = i + 1
+      else:
+         if run:
+            yield run
+         run = [i, i + 1]
+   if run:
+      yield run
 
-   cpu_stats_dict = cpu_stats_gen.next()
-   mem_stats_dict = get_mem_stats()
+class FrameRenderer:
+   '''Draws whole frames of text to a terminal, rewriting only the cells
+   that changed since the previous frame with cursor positioning escapes,
+   in a single write.  Anything but a terminal gets every frame in full
+   after a clear screen.'''
+
+   def __init__(self, fd=1):
+      self.fd = fd
+      self.tty = os.isatty(fd)
+      self.resize()
+
+   def resize(self):
+      '''Rereads the terminal size and redraws the next frame in full'''
+      self.size = self.tty and get_term_size(self.fd) or None
+      self.lines = None
+      self.cells = None
+
+   def draw(self, frame):
+      if not self.tty:
+         self.write(TermColors.CLEAR_SCREEN + '\n' + frame)
+         return
+
+      rows, cols = self.size or (None, None)
+      lines = frame.split('\n')[:rows]
+      # a row's cells are only split out once its line changes, and kept
+      # (or left as None) for as long as it doesn't
+      cells = [None] * len(lines)
+
+      out = list()
+      prev, prev_cells = self.lines, self.cells
+      if prev is None:
+         out.append(u'\x1b[H\x1b[2J')
+         prev, prev_cells = list(), list()
+      for row, line in enumerate(lines):
+         old_line, old = None, []
+         if row < len(prev):
+            old_line, old = prev[row], prev_cells[row]
+         if line == old_line:
+            cells[row] = old
+            continue
+         if old is None:
+            old = get_cells(old_line)[:cols]
+         new = cells[row] = get_cells(line)[:cols]
+         for start, end in get_changed_runs(old, new):
+            out.append(u'\x1b[%d;%dH' % (row + 1, start + 1))
+            attr = None
+            for c, a in new[start:end]:
+               if a != attr:
+                  out.append(a or u'\x1b[0m')
+                  attr = a
+               out.append(c)
+         if len(new) < len(old):
+            out.append(u'\x1b[%d;%dH\x1b[0m\x1b[K' % (row + 1, len(new) + 1))
+      for row in xrange(len(lines), len(prev)):
+         out.append(u'\x1b[%d;1H\x1b[0m\x1b[K' % (row + 1,))
+      self.lines, self.cells = lines, cells
+      if not out:
+         return
+      # leave the cursor below the frame in the default color
+      out.append(u'\x1b[0m\x1b[%d;1H' % (len(lines),))
+      self.write(u''.join(out).encode('utf-8'))
+
+   def write(self, data):
+      while data:
+         data = data[os.write(self.fd, data):]
+
+def render_stats(renderer, *args):
+   '''Builds the print_stats frame in memory and hands it to renderer'''
+   frame = StringIO()
+   stdout = sys.stdout
+   sys.stdout = frame
+   try:
+      print_stats(*args)
+   finally:
+      sys.stdout = stdout
+   renderer.draw(frame.getvalue())
+
+def print_stats(samples, verbose=False, cpu_view='auto', missed=None,
+      top=10, sort='cpu'):
+   cpu_info_dict = dict(samples['cpuinfo'])
+   cpu_info_dict['temperature'] = samples['temperature']
+   cpu_info_dict['loadavg'] = samples['loadavg']
 
-   print TermColors.CLEAR_SCREEN
    print_header()
    print_proc_info(cpu_info_dict, verbose)
-   print_battery_stats(batt_info_dict, verbose)
-   print_cpu_stats(cpu_stats_dict, verbose)
-   print_mem_stats(mem_stats_dict, verbose)
+   print_battery_stats(samples['battery'], verbose)
+   print_cpu_stats(samples['cpu'], verbose, cpu_view)
+   print_mem_stats(samples['mem'], verbose)
+   print_net_stats(samples['net'], verbose)
+   print_disk_stats(samples['disk'], verbose)
+   if 'procs' in samples:
+      print_process_stats(samples['procs'], verbose, top, sort)
 
+   if missed:
+      print "\nMissed deadlines: %s" % (', '.join("%s %d" % (k, missed[k])
+         for k in COLLECTORS if k in missed))
    print "\nCtrl-C to exit..."
 
+def get_record_struct(ncpus):
+   return struct.Struct('<d3f2f4I%df%df' % (len(CPU_STATES), ncpus))
+
+def get_battery_pct(info_dict):
+   '''Remaining charge in % of the last full capacity, NaN without a
+   battery'''
+   try:
+      return (float(info_dict['remaining capacity'].split('mAh')[0]) /
+         float(info_dict['last full capacity'].split('mAh')[0]) * 100.0)
+   except (KeyError, ValueError, ZeroDivisionError):
+      return NAN
+
+def get_kb(stats_dict, key):
+   try:
+      return int(stats_dict[key].strip("kB"))
+   except (KeyError, ValueError):
+      return 0
+
+class Recorder:
+   '''Appends fixed-width binary samples to a --record file through a
+   buffered writer.  The number of cpus is fixed by the first sample, or
+   by the header when appending to an existing file.  The first cpu
+   sample covers the time since boot, not an interval, so it is not
+   recorded.'''
+
+   def __init__(self, fn):
+      self.fn = fn
+      self.f = None
+      self.skip = True
+
+   def open(self, ncpus):
+      try:
+         with open(self.fn, 'rb') as f:
+            header = f.read(RECORD_HEADER.size)
+      except IOError:
+         header = ''
+      if header:
+         if len(header) < RECORD_HEADER.size:
+            raise ValueError("%s is not a mon.py recording" % (self.fn,))
+         magic, ncpus = RECORD_HEADER.unpack(header)
+         if magic != RECORD_MAGIC:
+            raise ValueError("%s is not a mon.py recording" % (self.fn,))
+      self.ncpus = ncpus
+      self.record_struct = get_record_struct(ncpus)
+      self.f = open(self.fn, 'ab', 1 << 16)
+      if not header:
+         self.f.write(RECORD_HEADER.pack(RECORD_MAGIC, ncpus))
+      else:
+         # drop a sample cut off mid write so the new ones stay aligned
+         size = os.fstat(self.f.fileno()).st_size - RECORD_HEADER.size
+         torn = size % self.record_struct.size
+         if torn:
+            self.f.truncate(RECORD_HEADER.size + size - torn)
+      self.flushed = monotonic()
+
+   def record(self, samples):
+      cpu = samples['cpu']
+      if self.f is None:
+         self.open(len(cpu['names']) - 1)
+      if self.skip:
+         self.skip = False
+         return
+
+      pcts, busy = get_cpu_pcts(cpu['deltas'])
+      cores = list(busy[1:self.ncpus + 1])
+      cores.extend([NAN] * (self.ncpus - len(cores)))
+      try:
+         load = [float(v) for v in samples['loadavg'].split()]
+      except ValueError:
+         load = [NAN] * 3
+      try:
+         temp = float(samples['temperature'].split('°')[0])
+      except ValueError:
+         temp = NAN
+      mem = samples['mem']
+
+      self.f.write(self.record_struct.pack(time.time(), *(load + [temp,
+         get_battery_pct(samples['battery']), get_kb(mem, 'MemTotal'),
+         get_kb(mem, 'MemFree'), get_kb(mem, 'SwapTotal'),
+         get_kb(mem, 'SwapFree')] + list(pcts[0]) + cores)))
+
+      now = monotonic()
+      if now - self.flushed >= RECORD_FLUSH_SECS:
+         self.f.flush()
+         self.flushed = now
+
+   def close(self):
+      if self.f:
+         self.f.close()
+
+def read_records(fn, block=4096):
+   '''Yields the number of cpus and then every complete sample of a
+   --record file, reading block samples at a time'''
+   with open(fn, 'rb') as f:
+      header = f.read(RECORD_HEADER.size)
+      if len(header) < RECORD_HEADER.size:
+         raise ValueError("%s is not a mon.py recording" % (fn,))
+      magic, ncpus = RECORD_HEADER.unpack(header)
+      if magic != RECORD_MAGIC:
+         raise ValueError("%s is not a mon.py recording" % (fn,))
+      yield ncpus
+
+      record_struct = get_record_struct(ncpus)
+      size = record_struct.size
+      while True:
+         buf = f.read(size * block)
+         # a partial sample at the end was cut off mid write, skip it
+         for offset in xrange(0, len(buf) - size + 1, size):
+            yield record_struct.unpack_from(buf, offset)
+         if len(buf) < size * block:
+            break
+
+def format_nan(format, v, missing='n/a'):
+   if v != v:
+      return missing
+   return format % (v,)
+
+def replay_records(fn):
+   records = read_records(fn)
+   records.next()
+   states = len(CPU_STATES)
+   for r in records:
+      pcts = r[10:10 + states]
+      busy = sum(pcts) - pcts[IDLE] - pcts[IOWAIT]
+      print "%s cpu %5.1f%% load %.2f %.2f %.2f mem %d/%dMB swap %d/%dMB " \
+         "temp %s batt %s" % (time.strftime('%Y-%m-%d %H:%M:%S',
+         time.localtime(r[0])), busy, r[1], r[2], r[3], (r[6] - r[7]) / 1024,
+         r[6] / 1024, (r[8] - r[9]) / 1024, r[8] / 1024,
+         format_nan('%.0f°C', r[4]), format_nan('%.0f%%', r[5]))
+
+def summarize_records(fn):
+   records = read_records(fn)
+   ncpus = records.next()
+   states = len(CPU_STATES)
+   # count, sum, min and max of every column, skipping NaN
+   columns = ['cpu busy %'] + ['cpu %s %%' % (s,) for s in CPU_STATES] + [
+      'load 1m', 'load 5m', 'load 15m', 'temperature C', 'battery %',
+      'mem used MB', 'swap used MB']
+   ncols = len(columns)
+   counts = [0] * (ncols + ncpus)
+   sums = [0.0] * (ncols + ncpus)
+   mins = [None] * (ncols + ncpus)
+   maxs = [None] * (ncols + ncpus)
+   first = last = None
+   for r in records:
+      if first is None:
+         first = r[0]
+      last = r[0]
+      pcts = r[10:10 + states]
+      values = [sum(pcts) - pcts[IDLE] - pcts[IOWAIT]]
+      values.extend(pcts)
+      values.extend(r[1:6])
+      values.append((r[6] - r[7]) / 1024.0)
+      values.append((r[8] - r[9]) / 1024.0)
+      values.extend(r[10 + states:])
+      for i, v in enumerate(values):
+         if v != v:
+            continue
+         counts[i] += 1
+         sums[i] += v
+         if mins[i] is None or v < mins[i]:
+            mins[i] = v
+         if maxs[i] is None or v > maxs[i]:
+            maxs[i] = v
+
+   if first is None:
+      print "%s: no samples" % (fn,)
+      return
+   print "%d samples over %s, %s to %s" % (counts[0], timedelta(
+      seconds=int(last - first)), time.strftime('%Y-%m-%d %H:%M:%S',
+      time.localtime(first)), time.strftime('%Y-%m-%d %H:%M:%S',
+      time.localtime(last)))
+   print "%s %10s %10s %10s" % ("".ljust(TITLE_WIDTH), "min", "mean", "max")
+   for i, name in enumerate(columns):
+      if counts[i]:
+         print "%s %10.2f %10.2f %10.2f" % (name.ljust(TITLE_WIDTH), mins[i],
+            sums[i] / counts[i], maxs[i])
+
+   busiest = sorted(((sums[ncols + i] / counts[ncols + i], i)
+      for i in xrange(ncpus) if counts[ncols + i]), reverse=True)[:8]
+   if busiest:
+      print "busiest cpus: %s" % (', '.join("cpu%d %.1f%%" % (i, mean)
+         for mean, i in busiest))
+
 def handle_break(signum, frame):
-   print "Monitoring interrupted, exiting..."
+   # not into a frame render_stats is building
+   print >> sys.__stdout__, "Monitoring interrupted, exiting..."
    sys.exit(0)
 
 def main():
@@ -300,17 +1048,85 @@ def main():
       action="store_true")
    parser.add_option("-s", "--seconds", help="Get stats every N seconds.",
       default=float(5))
+   parser.add_option("-i", "--interval", help="Sample collector NAME every "
+      "SECS seconds instead, 0 samples it once.  Collectors: %s; battery "
+      "defaults to %ds and cpuinfo to once." % (', '.join(COLLECTORS),
+      DEFAULT_INTERVALS['battery']), action="append", metavar="NAME=SECS")
    parser.add_option("-o", "--once", help="Run once and exit, do not loop.",
       action="store_true")
+   parser.add_option("-c", "--cpu-view", help="Draw a bar per cpu, a "
+      "heatmap of all cpus or only the aggregate, auto picks bars for up to "
+      "%d cpus. [%%default]" % HEATMAP_CPUS, default="auto",
+      choices=["auto", "bars", "heatmap", "aggregate"])
+   parser.add_option("-t", "--top", help="Show the top N processes, 0 "
+      "hides them. [%default]", type="int", default=10)
+   parser.add_option("--sort", help="Rank the top processes by cpu or "
+      "rss. [%default]", choices=["cpu", "rss"], default="cpu")
+   parser.add_option("--record", help="Append cpu, memory, load, "
+      "temperature and battery samples to FILE instead of drawing them.",
+      metavar="FILE")
+   parser.add_option("--replay", help="Print the samples recorded in FILE.",
+      metavar="FILE")
+   parser.add_option("--summarize", help="Print the min, mean and max of "
+      "the samples recorded in FILE.", metavar="FILE")
    opts, args = parser.parse_args()
    verbose = opts.verbose
 
    signal.signal(signal.SIGINT, handle_break)
 
-   if not opts.once:
-      do_every(float(opts.seconds), print_stats, verbose)
+   try:
+      if opts.replay:
+         replay_records(opts.replay)
+         return
+      if opts.summarize:
+         summarize_records(opts.summarize)
+         return
+   except IOError, e:
+      if e.errno != errno.EPIPE:
+         parser.error(str(e))
+      # reader went away (eg. piped into head), drop whatever is still
+      # buffered so the exit flush doesn't fail too
+      os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+      return
+   except ValueError, e:
+      parser.error(str(e))
+
+   try:
+      intervals = get_intervals(opts.interval, float(opts.seconds))
+   except ValueError, e:
+      parser.error(str(e))
+
+   collectors = get_collectors()
+   scheduler = Scheduler()
+   for name in COLLECTORS:
+      if name == 'procs' and not opts.top:
+         continue
+      if not opts.record or name in RECORD_COLLECTORS:
+         scheduler.add(name, intervals[name], collectors[name])
+
+   if opts.record:
+      # headless, also stop cleanly when a service manager asks to
+      signal.signal(signal.SIGTERM, handle_break)
+      recorder = Recorder(opts.record)
+      try:
+         scheduler.run(lambda ran: recorder.record(scheduler.samples))
+      except ValueError, e:
+         parser.error(str(e))
+      finally:
+         recorder.close()
    else:
-      print_stats(verbose)
+      sys.stdout.flush()
+      renderer = FrameRenderer(sys.stdout.fileno())
+      if opts.once:
+         scheduler.run_due(monotonic())
+         render_stats(renderer, scheduler.samples, verbose, opts.cpu_view,
+            None, opts.top, opts.sort)
+         return
+
+      signal.signal(signal.SIGWINCH, lambda signum, frame: renderer.resize())
+      signal.siginterrupt(signal.SIGWINCH, False)
+      scheduler.run(lambda ran: render_stats(renderer, scheduler.samples,
+         verbose, opts.cpu_view, scheduler.missed, opts.top, opts.sort))
 
 if __name__ == "__main__":
    main()
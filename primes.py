@@ -1,7 +1,32 @@
+from array import array
+from bisect import bisect_right
 from contextlib import contextmanager
-from math import sqrt
+from collections import deque
+from itertools import chain, compress, imap, izip, repeat
+from math import ceil, log, sqrt
+from operator import sub
+import binascii
+import csv
+import errno
+import fcntl
+import mmap
+import multiprocessing
+import hashlib
+import json
 import optparse
+import os
+import resource
+import signal
+import string
+import struct
+import sys
 import time
+import timeit
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 """
     primes.py: Generate primes using the following sieve algorithms (from slowest to fastest)
@@ -10,8 +35,18 @@ import time
         - Sieve of Euler
         - Sieve of Sundaram
         - Sieve of Atkin
+        - Segmented Sieve of Eratosthenes
 """
 
+# Number of odd candidates sieved at a time by the segmented sieve.  One
+# byte per candidate, so a segment stays resident in a typical L2 cache.
+SEGMENT_SIZE = 1 << 19
+
+CACHE_DIR = os.path.expanduser('~/.cache/primes')
+
+# Range sizes benchmarked by --bench unless --bench-sizes is given
+BENCH_SIZES = (10**3, 10**4, 10**5, 10**6)
+
 def timethis(what):
     @contextmanager
     def benchmark():
@@ -37,7 +72,7 @@ def brute_force_primes(start, end, verbose=False):
             i = i + 1
         return True
 
-    return [i for i in xrange(start, end) if is_prime(i)]
+    return [i for i in xrange(max(start, 2), end) if is_prime(i)]
 
 def sieve_of_eratosthenes(start, end, verbose=False):
     """
@@ -127,7 +162,6 @@ def sieve_of_euler(start, end, verbose=False):
     primes = filter(lambda x: x >= start, primes)
     return primes
 
-@timethis
 def sieve_of_sundaram(start, end, verbose=False):
     """
     >>> sieve_of_sundaram(2, 20)
@@ -137,7 +171,7 @@ def sieve_of_sundaram(start, end, verbose=False):
     """
     # http://en.wikipedia.org/wiki/Sieve_of_Sundaram
     def sieve_sundaram(primes, end):
-        mid = int(end / 2)
+        mid = len(primes) + 1
         initial = 4
         for step in xrange(3, end+1, 2):
             for i in xrange(initial, mid, step):
@@ -216,52 +250,1172 @@ def sieve_of_atkin(start, end, verbose=False):
             primes_dict)
     return primes
 
+def sieve_of_sundaram_numpy(start, end, verbose=False):
+    """
+    NumPy backend for sieve_of_sundaram, falls back to it without NumPy.
+    >>> sieve_of_sundaram_numpy(2, 20)
+    [2, 3, 5, 7, 11, 13, 17, 19]
+    >>> sieve_of_sundaram_numpy(30, 40)
+    [31, 37]
+    """
+    if numpy is None:
+        return sieve_of_sundaram(start, end, verbose)
+    #
+    # k survives when 2k + 1 is prime, i + j + 2ij is struck out for every
+    # 1 <= i <= j, one strided slice per i.
+    #
+    last = (end - 1) // 2
+    marks = numpy.ones(last + 1, dtype=numpy.bool_)
+    marks[0] = False
+    i = 1
+    while 2 * i * (i + 1) <= last:
+        marks[2 * i * (i + 1)::2 * i + 1] = False
+        i += 1
+    primes = 2 * numpy.flatnonzero(marks) + 1
+    primes = primes[primes >= start].tolist()
+    if start < 3:
+        primes.insert(0, 2)
+    return primes
+
+def sieve_of_atkin_numpy(start, end, verbose=False):
+    """
+    NumPy backend for sieve_of_atkin, falls back to it without NumPy.
+    Returns the same primes, in ascending order.
+    >>> sorted(sieve_of_atkin_numpy(2, 20))
+    [2, 3, 5, 7, 11, 13, 17, 19]
+    >>> sorted(sieve_of_atkin_numpy(30, 40))
+    [31, 37]
+    >>> sieve_of_atkin_numpy(3, 2)
+    []
+    >>> sieve_of_atkin_numpy(0, -1)
+    Traceback (most recent call last):
+    ...
+    ValueError: Start and End values must be positive integers
+    """
+    if numpy is None:
+        return sieve_of_atkin(start, end, verbose)
+    if start < 0 or end < 0:
+        raise ValueError, "Start and End values must be positive integers"
+    #
+    # Same quadratic forms as sieve_of_atkin, but each x toggles a whole row
+    # of y values at once.  n is distinct along a row so a fancy-indexed
+    # xor flips every candidate the right number of times.
+    #
+    last = long(sqrt(end)) + 1
+    flags = numpy.zeros(end + 1, dtype=numpy.bool_)
+    y2 = numpy.arange(1, last, dtype=numpy.int64) ** 2
+    for x in xrange(1, last):
+        x2 = x * x
+        n = 4 * x2 + y2
+        n = n[n <= end]
+        n = n[(n % 12 == 1) | (n % 12 == 5)]
+        flags[n] ^= True
+
+        n = 3 * x2 + y2
+        n = n[n <= end]
+        n = n[n % 12 == 7]
+        flags[n] ^= True
+
+        n = 3 * x2 - y2[:x - 1]
+        n = n[n <= end]
+        n = n[n % 12 == 11]
+        flags[n] ^= True
+    # sieve primes
+    for n in xrange(5, min(last, end) + 1):
+        if flags[n]:
+            flags[n * n::n * n] = False
+    flags[2:4] = True
+    primes = numpy.flatnonzero(flags[start:end + 1]) + start
+    return primes.tolist()
+
+#
+# Backends that can stand in for an algorithm in algorithm_dct.
+#
+backend_dct = {
+    'numpy': {
+        'sundaram': ('Sieve of Sundaram (NumPy)', sieve_of_sundaram_numpy),
+        'atkin': ('Sieve of Atkin (NumPy)', sieve_of_atkin_numpy),
+    },
+}
+
+def _isqrt(n):
+    """Returns the largest integer r such that r * r <= n"""
+    r = int(sqrt(n))
+    while r * r > n:
+        r -= 1
+    while (r + 1) * (r + 1) <= n:
+        r += 1
+    return r
+
+def _base_primes(limit):
+    """Returns the odd primes <= limit, used to sieve the segments"""
+    if limit < 3:
+        return []
+    # flags[i] stands for the odd number 2 * i + 1
+    flags = bytearray([1]) * (limit // 2 + 1)
+    flags[0] = 0
+    for i in xrange(1, _isqrt(limit) // 2 + 1):
+        if flags[i]:
+            p = 2 * i + 1
+            j = p * p // 2
+            flags[j::p] = bytearray(len(xrange(j, len(flags), p)))
+    return list(compress(xrange(1, limit + 1, 2), flags))
+
+def _segments(start, end, size=SEGMENT_SIZE):
+    """Yields (lo, hi) pairs covering the odd numbers in [start, end), lo odd"""
+    lo = max(start, 3) | 1
+    while lo < end:
+        hi = min(lo + 2 * size, end)
+        yield lo, hi
+        lo = hi | 1
+
+def _sieve_segment(lo, hi, base_primes):
+    """
+    Returns a bytearray where flag i is set if lo + 2 * i is prime.
+    lo must be odd and base_primes must hold every odd prime <= sqrt(hi).
+    """
+    size = (hi - lo + 1) // 2
+    flags = bytearray([1]) * size
+    for p in base_primes:
+        m = p * p
+        if m >= hi:
+            break
+        if m < lo:
+            # first odd multiple of p in the segment
+            m = lo + (-lo) % p
+            if not m & 1:
+                m += p
+        i = (m - lo) // 2
+        if i < size:
+            flags[i::p] = bytearray((size - 1 - i) // p + 1)
+    if lo == 1:
+        flags[0] = 0
+    return flags
+
+def _sieve_worker(conn, base_primes):
+    """Sieves the (lo, hi) segments sent over conn until it gets None"""
+    # the parent handles Ctrl-C and kills the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        bounds = conn.recv()
+        if bounds is None:
+            break
+        conn.send_bytes(buffer(_sieve_segment(bounds[0], bounds[1],
+                base_primes)))
+
+class _SievePool(object):
+    """
+    Worker processes sieving segments for _prime_chunks, each fed over its
+    own pipe.  Segment k goes to worker k % workers, so the flags come
+    back in order, and each worker has at most two segments queued, so a
+    slow consumer does not let finished segments pile up.  The base primes
+    reach the workers once, when they fork.  close() kills the workers
+    outright, so stopping early never waits on segments still in flight.
+    """
+    def __init__(self, workers, base_primes):
+        self.procs = []
+        self.conns = []
+        for i in xrange(workers):
+            conn, child = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=_sieve_worker,
+                    args=(child, base_primes))
+            # never keep the interpreter from exiting
+            proc.daemon = True
+            proc.start()
+            child.close()
+            self.procs.append(proc)
+            self.conns.append(conn)
+
+    def segments(self, start, end):
+        """
+        Yields (lo, hi, flags) for each segment of [start, end).  flags is
+        one bytearray reused for every segment, only its first (hi - lo + 1)
+        // 2 bytes belong to the current one.
+        """
+        conns = self.conns
+        segments = _segments(start, end)
+        pending = deque()
+        for bounds in segments:
+            conns[len(pending) % len(conns)].send(bounds)
+            pending.append(bounds)
+            if len(pending) == 2 * len(conns):
+                break
+        flags = bytearray(SEGMENT_SIZE)
+        k = 0
+        while pending:
+            lo, hi = pending.popleft()
+            conn = conns[k % len(conns)]
+            conn.recv_bytes_into(flags)
+            # the worker that just finished takes the next segment in turn
+            for bounds in segments:
+                conn.send(bounds)
+                pending.append(bounds)
+                break
+            yield lo, hi, flags
+            k += 1
+
+    def close(self):
+        for proc in self.procs:
+            if proc.is_alive():
+                proc.terminate()
+        for proc in self.procs:
+            proc.join()
+        for conn in self.conns:
+            conn.close()
+
+def _sieve_pool(end, workers):
+    """A _SievePool for ranges up to end, None when workers <= 1"""
+    if workers <= 1 or end <= 3:
+        return None
+    return _SievePool(workers, _base_primes(_isqrt(end - 1)))
+
+def _prime_chunks(start, end, pool=None):
+    """
+    Yields the primes in [start, end) as one list per sieved segment, in
+    this process or in pool, which the caller owns and closes.
+    """
+    if start <= 2 < end:
+        yield [2]
+    if end <= 3:
+        return
+    if pool:
+        for lo, hi, flags in pool.segments(start, end):
+            # compress stops at the end of the xrange, before the stale
+            # tail of the reused buffer
+            yield list(compress(xrange(lo, hi, 2), flags))
+        return
+    base_primes = _base_primes(_isqrt(end - 1))
+    for lo, hi in _segments(start, end):
+        flags = _sieve_segment(lo, hi, base_primes)
+        yield list(compress(xrange(lo, hi, 2), flags))
+
+def segmented_sieve(start, end, verbose=False, workers=1):
+    """
+    Typical usage
+    >>> segmented_sieve(2, 20)
+    [2, 3, 5, 7, 11, 13, 17, 19]
+
+    Test truncated list
+    >>> segmented_sieve(30, 40)
+    [31, 37]
+
+    End is exclusive
+    >>> segmented_sieve(0, 7)
+    [2, 3, 5]
+
+    Ranges far from zero
+    >>> segmented_sieve(10**6, 10**6 + 100)
+    [1000003, 1000033, 1000037, 1000039, 1000081, 1000099]
+
+    Sieve segments in a pool of worker processes
+    >>> segmented_sieve(0, 10**5, workers=2) == segmented_sieve(0, 10**5)
+    True
+
+    Bad range returns empty list
+    >>> segmented_sieve(3, 2)
+    []
+
+    Bad input raise a value error
+    >>> segmented_sieve(0, -1)
+    Traceback (most recent call last):
+    ...
+    ValueError: Start and End values must be positive integers
+    """
+    #
+    # Sieves [start, end) one cache-sized segment of odd numbers at a time,
+    # using only the primes up to sqrt(end), so memory is bounded by the
+    # segment size no matter how large start and end are.  With workers > 1
+    # the segments are sieved in a process pool and collected in order.
+    #
+    if start < 0 or end < 0:
+        raise ValueError, "Start and End values must be positive integers"
+    primes = []
+    pool = _sieve_pool(end, workers)
+    try:
+        for chunk in _prime_chunks(start, end, pool):
+            primes.extend(chunk)
+    finally:
+        if pool:
+            pool.close()
+    return primes
+
+def iter_segmented_sieve(start, end, verbose=False, workers=1):
+    """
+    Generator variant of segmented_sieve, only one segment of primes is
+    held in memory at a time.
+    >>> primes = iter_segmented_sieve(2, 10**12)
+    >>> [primes.next() for i in xrange(8)]
+    [2, 3, 5, 7, 11, 13, 17, 19]
+
+    Bad input raise a value error
+    >>> iter_segmented_sieve(0, -1)
+    Traceback (most recent call last):
+    ...
+    ValueError: Start and End values must be positive integers
+    """
+    if start < 0 or end < 0:
+        raise ValueError, "Start and End values must be positive integers"
+    return _iter_primes(start, end, workers)
+
+def _iter_primes(start, end, workers):
+    # close() stops the pool; the workers are daemons, so a generator
+    # dropped unfinished does not hold up interpreter exit either
+    pool = _sieve_pool(end, workers)
+    try:
+        for chunk in _prime_chunks(start, end, pool):
+            for prime in chunk:
+                yield prime
+    finally:
+        if pool:
+            pool.close()
+
+def prime_pi(x):
+    """
+    Returns the number of primes <= x.
+    >>> [prime_pi(x) for x in xrange(12)]
+    [0, 0, 1, 2, 2, 3, 3, 4, 4, 4, 4, 5]
+    >>> prime_pi(10**6)
+    78498
+    >>> prime_pi(10**9)
+    50847534
+    """
+    #
+    # Lucy_Hedgehog's method: S(v) counts the numbers in [2, v] that survive
+    # sieving by the primes < p, for the O(sqrt(x)) distinct values x // i.
+    # Removing p gives S(v) -= S(v // p) - S(p - 1).  small[v] holds S(v)
+    # for v <= sqrt(x) and large[i] holds S(x // i), each update is done a
+    # whole slice at a time with map().
+    #
+    if x < 2:
+        return 0
+    r = _isqrt(x)
+    small = range(-1, r)
+    small[0] = 0
+    large = [0] + [x // i - 1 for i in xrange(1, r + 1)]
+    for p in xrange(2, r + 1):
+        sp = small[p - 1]
+        if small[p] == sp:
+            # p is not prime
+            continue
+        p2 = p * p
+        # large[i] for i <= r // p reads large[i * p], the rest read small
+        lim = min(r, x // p2)
+        m = min(r // p, lim)
+        terms = large[p:m * p + 1:p]
+        if lim > m:
+            terms += [small[x // d] for d in xrange((m + 1) * p, lim * p + 1, p)]
+        large[1:lim + 1] = map(sub, large[1:lim + 1], [t - sp for t in terms])
+        if p2 <= r:
+            # small[v // p] is constant over each run of p values of v
+            deltas = chain.from_iterable(repeat(small[q] - sp, p)
+                    for q in xrange(p, r // p + 1))
+            small[p2:] = imap(sub, small[p2:], deltas)
+    return large[1]
+
+def count_primes(start, end):
+    """
+    Returns the number of primes in [start, end) without listing them.
+    >>> count_primes(2, 20)
+    8
+    >>> count_primes(30, 40)
+    2
+    >>> count_primes(3, 2)
+    0
+    """
+    if end <= start:
+        return 0
+    return prime_pi(end - 1) - prime_pi(start - 1)
+
+def _nth_prime_upper_bound(n):
+    """
+    Returns an upper bound for the nth prime (Rosser's theorem, with
+    Dusart's tighter bound for n >= 688383).
+    """
+    if n < 6:
+        return 13
+    ln_n = log(n)
+    ln_ln_n = log(ln_n)
+    if n >= 688383:
+        return long(n * (ln_n + ln_ln_n - 1 + (ln_ln_n - 2) / ln_n)) + 1
+    return long(n * (ln_n + ln_ln_n)) + 1
+
+def _nth_prime_lower_bound(n):
+    """Returns a lower bound for the nth prime (Dusart, n >= 2)"""
+    if n < 6:
+        return 2
+    ln_n = log(n)
+    return long(n * (ln_n + log(ln_n) - 1))
+
+def nth_prime(n):
+    """
+    Returns the nth prime number, counting 2 as the first.
+    >>> nth_prime(1)
+    2
+    >>> [nth_prime(n) for n in xrange(2, 8)]
+    [3, 5, 7, 11, 13, 17]
+    >>> nth_prime(10**4)
+    104729
+    >>> nth_prime(10**6)
+    15485863
+
+    Bad input raise a value error
+    >>> nth_prime(0)
+    Traceback (most recent call last):
+    ...
+    ValueError: n must be a positive integer
+    """
+    #
+    # Counts the primes below a lower bound for the nth prime with prime_pi,
+    # then sieves segment by segment up to the upper bound, counting the
+    # primes in each segment and only decoding the one that holds the nth.
+    #
+    if n < 1:
+        raise ValueError, "n must be a positive integer"
+    if n == 1:
+        return 2
+    start = max(_nth_prime_lower_bound(n), 3)
+    count = prime_pi(start - 1)
+    end = _nth_prime_upper_bound(n) + 1
+    base_primes = _base_primes(_isqrt(end - 1))
+    for lo, hi in _segments(start, end):
+        flags = _sieve_segment(lo, hi, base_primes)
+        found = flags.count('\x01')
+        if count + found >= n:
+            for p in compress(xrange(lo, hi, 2), flags):
+                count += 1
+                if count == n:
+                    return p
+        count += found
+
+#
+# Primes used to pre-filter is_prime candidates by trial division, and the
+# Miller-Rabin witnesses that are deterministic for every n < 3.18 * 10**23
+# (which covers all 64-bit integers).
+#
+_SMALL_PRIMES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47,
+        53, 59, 61, 67, 71, 73, 79, 83, 89, 97)
+_WITNESSES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37)
+
+def is_prime(n):
+    """
+    Returns True if n is prime, using Miller-Rabin.  Exact for n below
+    3.18 * 10**23, a strong probable prime test beyond that.
+    >>> [n for n in xrange(30) if is_prime(n)]
+    [2, 3, 5, 7, 11, 13, 17, 19, 23, 29]
+    >>> is_prime(2**61 - 1)
+    True
+    >>> is_prime(3825123056546413051)
+    False
+    >>> is_prime(2**64 - 59)
+    True
+    """
+    if n < 2:
+        return False
+    for p in _SMALL_PRIMES:
+        if n % p == 0:
+            return n == p
+    if n < 101 * 101:
+        return True
+    d = n - 1
+    s = 0
+    while not d & 1:
+        d >>= 1
+        s += 1
+    for a in _WITNESSES:
+        x = pow(a, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for i in xrange(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+def is_prime_many(numbers):
+    """
+    Returns a list with is_prime(n) for each n.  Numbers below one segment
+    are looked up in a single sieved table instead of tested one by one.
+    >>> is_prime_many([1, 2, 9, 97, 2**61 - 1, 2**61 + 1])
+    [False, True, False, True, True, False]
+
+    Negative numbers are not prime
+    >>> is_prime_many([-3, -5])
+    [False, False]
+    """
+    numbers = list(numbers)
+    small = [n for n in numbers if 0 <= n < 2 * SEGMENT_SIZE]
+    if len(small) < 2:
+        return map(is_prime, numbers)
+    end = max(small) + 1
+    flags = bytearray(end)
+    if end > 2:
+        flags[2] = 1
+    if end > 3:
+        flags[3::2] = _sieve_segment(3, end, _base_primes(_isqrt(end - 1)))
+    return [bool(flags[n]) if 0 <= n < end else is_prime(n)
+            for n in numbers]
+
+algorithm_dct = {
+    'segmented': ('Segmented Sieve of Eratosthenes', segmented_sieve),
+    'sundaram': ('Sieve of Sundaram', sieve_of_sundaram),
+    'euler': ('Sieve of Euler', sieve_of_euler),
+    'atkin': ('Sieve of Atkin', sieve_of_atkin),
+    'eratosthenes': ('Sieve of Eratosthenes', sieve_of_eratosthenes),
+    'brute': ('Brute Force', brute_force_primes),
+}
+
+def get_algorithm(opts):
+    name = opts.algorithm.lower()
+    desc, prime_func = algorithm_dct.get(name, algorithm_dct['segmented'])
+    if opts.backend != 'python':
+        if opts.backend == 'numpy' and numpy is None:
+            print >>sys.stderr, "NumPy is not installed, " \
+                    "using the pure Python backend"
+        elif name in backend_dct.get(opts.backend, {}):
+            desc, prime_func = backend_dct[opts.backend][name]
+        else:
+            print >>sys.stderr, "%s has no %s backend, using pure Python" \
+                    % (desc, opts.backend)
+    if opts.workers > 1 and prime_func is not segmented_sieve:
+        print >>sys.stderr, "%s does not support --workers, " \
+                "using 1 process" % desc
+    return desc, prime_func
+
+#
+# Bit packing helpers: a flag bytearray holds one 0/1 byte per
+# candidate, its packed form holds 8 candidates per byte, least
+# significant bit first.  Both directions go through one big integer so
+# the work is done in C rather than a Python loop per byte.
+#
+_BIT_CHARS = string.maketrans('\x00\x01', '01')
+_FLAG_CHARS = string.maketrans('01', '\x00\x01')
+
+def _pack_bits(flags):
+    """
+    >>> _pack_bits(bytearray([1, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0]))
+    '\\x01\\x06'
+    """
+    n = len(flags) // 8
+    if not n:
+        return ''
+    bits = str(flags).translate(_BIT_CHARS)[::-1]
+    return binascii.unhexlify('%0*x' % (2 * n, int(bits, 2)))[::-1]
+
+def _unpack_bits(data):
+    """
+    >>> list(_unpack_bits('\\x01\\x06'))
+    [1, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0]
+    """
+    if not len(data):
+        return bytearray()
+    # data may be a buffer over a mmap, which can't be sliced with a step,
+    # so read it in order and flip each byte's bits while spreading them out
+    v = int(binascii.hexlify(data), 16)
+    bits = bin(v)[2:].zfill(8 * len(data)).translate(_FLAG_CHARS)
+    flags = bytearray(len(bits))
+    for k in xrange(8):
+        flags[k::8] = bits[7 - k::8]
+    return flags
+
+class PrimeCache(object):
+    """
+    Persistent table of the primes in [0, limit), stored as an odd-only
+    bitmap in a memory-mapped file: bit k of byte i is set if
+    16 * i + 2 * k + 1 is prime.  Queries past the limit sieve just the
+    missing gap and append it to the file, unless the gap dwarfs the query
+    itself: those are sieved on their own and not kept.
+
+    >>> import shutil, tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> cache = PrimeCache(d)
+    >>> cache.limit
+    0
+    >>> cache.primes(2, 20)
+    [2, 3, 5, 7, 11, 13, 17, 19]
+    >>> cache.limit
+    32
+    >>> cache.close()
+    >>> cache = PrimeCache(d)
+    >>> cache.limit
+    32
+    >>> cache.primes(30, 40)
+    [31, 37]
+    >>> cache.primes(0, 10**5) == segmented_sieve(0, 10**5)
+    True
+    >>> cache.primes(10**12, 10**12 + 100)
+    [1000000000039, 1000000000061, 1000000000063, 1000000000091]
+    >>> cache.limit
+    100000
+    >>> cache.close()
+    >>> shutil.rmtree(d)
+    """
+    FILENAME = 'primes.bitmap'
+    MAGIC = 'PRIMBMP1'
+    HEADER = struct.Struct('<8sQ')
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.path = os.path.join(cache_dir, self.FILENAME)
+        if not os.path.exists(self.path):
+            with open(self.path, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, 0))
+        self.file = open(self.path, 'r+b')
+        self.map = None
+        self._remap()
+
+    def _remap(self):
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.limit = self.HEADER.unpack_from(self.map)
+        if magic != self.MAGIC:
+            raise ValueError, "%s is not a prime cache file" % self.path
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def extend(self, end):
+        """Sieves [limit, end) and appends it to the cache file"""
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        try:
+            # another process may have extended the file meanwhile
+            self._remap()
+            end = (end + 15) // 16 * 16
+            if end <= self.limit:
+                return
+            # drop anything left behind by an interrupted extension
+            self.file.truncate(self.HEADER.size + self.limit // 16)
+            self.file.seek(0, os.SEEK_END)
+            base_primes = _base_primes(_isqrt(end - 1))
+            for lo in xrange(self.limit + 1, end, 2 * SEGMENT_SIZE):
+                hi = min(lo - 1 + 2 * SEGMENT_SIZE, end)
+                self.file.write(_pack_bits(_sieve_segment(lo, hi, base_primes)))
+            self.file.seek(0)
+            self.file.write(self.HEADER.pack(self.MAGIC, end))
+            self.file.flush()
+            self._remap()
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    def primes(self, start, end):
+        """Returns the primes in [start, end), extending the cache if needed"""
+        if start < 0 or end < 0:
+            raise ValueError, "Start and End values must be positive integers"
+        primes = []
+        if start <= 2 < end:
+            primes.append(2)
+        start = max(start, 3)
+        if end <= start:
+            return primes
+        if start - self.limit > max(end - start, 2 * SEGMENT_SIZE):
+            # filling the gap would cost far more than the query
+            primes.extend(segmented_sieve(start, end))
+            return primes
+        if end > self.limit:
+            self.extend(end)
+        # decode a segment's worth of bytes at a time straight off the map
+        step = SEGMENT_SIZE // 8
+        for i in xrange(start // 16, (end + 15) // 16, step):
+            j = min(i + step, (end + 15) // 16)
+            flags = _unpack_bits(buffer(self.map, self.HEADER.size + i, j - i))
+            first = 16 * i + 1
+            lo = max(start - first + 1, 0) // 2
+            hi = min(end - first + 1, 16 * (j - i)) // 2
+            primes.extend(compress(xrange(first + 2 * lo, first + 2 * hi, 2),
+                flags[lo:hi]))
+        return primes
+
+#
+# The mod 30 wheel: only 8 residues can hold a prime above 5, one bit each.
+#
+_WHEEL = (1, 7, 11, 13, 17, 19, 23, 29)
+_WHEEL_BIT = dict((r, b) for b, r in enumerate(_WHEEL))
+# _WHEEL_MASK[r] selects the bits for residues <= r
+_WHEEL_MASK = [sum(1 << b for b, w in enumerate(_WHEEL) if w <= r)
+        for r in xrange(30)]
+_BIT_COUNTS = [bin(i).count('1') for i in xrange(256)]
+_POPCOUNT = ''.join(map(chr, _BIT_COUNTS))
+
+def _popcount(data):
+    return sum(bytearray(data).translate(_POPCOUNT))
+
+class PrimeSet(object):
+    """
+    Compact, immutable set of the primes in [start, end).  Bit b of byte k
+    is set if 30 * (start // 30 + k) + _WHEEL[b] is prime, so every 30
+    integers cost one byte; 2, 3 and 5 are kept aside.  The set takes
+    ownership of the data bytearray it is given and trims it in place.
+
+    >>> primes = prime_set(0, 100)
+    >>> primes
+    <PrimeSet of 25 primes in [0, 100)>
+    >>> 97 in primes, 91 in primes, 2 in primes
+    (True, False, True)
+    >>> list(primes[10:30])
+    [11, 13, 17, 19, 23, 29]
+    >>> primes.rank(29), primes.select(9)
+    (10, 29)
+    >>> list(PrimeSet.from_primes([7, 3, 31, 2], 3, 31))
+    [3, 7]
+    >>> primes[5]
+    Traceback (most recent call last):
+    ...
+    TypeError: PrimeSet can only be sliced by value, use select()
+    """
+    BLOCK = 1024
+
+    def __init__(self, start, end, data, small=()):
+        self.start = start
+        self.end = end
+        self.offset = int(start // 30)
+        self.small = tuple(p for p in small if start <= p < end)
+        if end <= start:
+            self.data = bytearray()
+        else:
+            # drop the bits of the edge bytes that fall outside the range
+            last = (end - 1) // 30 - self.offset
+            self.data = data
+            del self.data[last + 1:]
+            self.data[0] &= ~_WHEEL_MASK[(start - 1) % 30] \
+                    if start % 30 else 0xff
+            self.data[last] &= _WHEEL_MASK[(end - 1) % 30]
+        # _ranks[i] is the number of set bits before block i
+        self._ranks = array('L', [0])
+        for i in xrange(0, len(self.data), self.BLOCK):
+            self._ranks.append(self._ranks[-1] +
+                    _popcount(self.data[i:i + self.BLOCK]))
+
+    @classmethod
+    def from_primes(cls, primes, start, end):
+        """Packs primes, in any order, dropping those outside [start, end)"""
+        offset = start // 30
+        data = bytearray(max((end - 1) // 30 - offset + 1, 0))
+        small = []
+        for p in primes:
+            if not start <= p < end:
+                continue
+            if p < 7:
+                small.append(p)
+                continue
+            bit = _WHEEL_BIT.get(p % 30)
+            if bit is None:
+                raise ValueError, "%d is not a prime" % p
+            data[p // 30 - offset] |= 1 << bit
+        return cls(start, end, data, sorted(small))
+
+    def __repr__(self):
+        return "<PrimeSet of %d primes in [%d, %d)>" % (len(self),
+                self.start, self.end)
+
+    def __len__(self):
+        return len(self.small) + int(self._ranks[-1])
+
+    def __contains__(self, n):
+        if not self.start <= n < self.end:
+            return False
+        if n < 7:
+            return n in self.small
+        bit = _WHEEL_BIT.get(n % 30)
+        if bit is None:
+            return False
+        return bool(self.data[n // 30 - self.offset] >> bit & 1)
+
+    def __iter__(self):
+        for p in self.small:
+            yield p
+        step = SEGMENT_SIZE // 8
+        for i in xrange(0, len(self.data), step):
+            flags = _unpack_bits(buffer(self.data, i, step))
+            base = 30 * (self.offset + i)
+            for j in compress(xrange(len(flags)), flags):
+                yield base + 30 * (j >> 3) + _WHEEL[j & 7]
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step is not None:
+            raise TypeError, "PrimeSet can only be sliced by value, use select()"
+        start = self.start if key.start is None else max(key.start, self.start)
+        end = self.end if key.stop is None else min(key.stop, self.end)
+        i = start // 30 - self.offset
+        j = max((end - 1) // 30 - self.offset + 1, i)
+        return PrimeSet(start, end, self.data[i:j], self.small)
+
+    def rank(self, x):
+        """Returns the number of primes in the set that are <= x"""
+        count = sum(1 for p in self.small if p <= x)
+        k = x // 30 - self.offset
+        if k < 0 or x < 7:
+            return count
+        if k >= len(self.data):
+            return count + int(self._ranks[-1])
+        block = k // self.BLOCK
+        count += int(self._ranks[block])
+        count += _popcount(self.data[block * self.BLOCK:k])
+        return count + _BIT_COUNTS[self.data[k] & _WHEEL_MASK[x % 30]]
+
+    def select(self, i):
+        """Returns the ith smallest prime in the set, counting from 0"""
+        if not 0 <= i < len(self):
+            raise IndexError, "PrimeSet index out of range"
+        if i < len(self.small):
+            return self.small[i]
+        i -= len(self.small)
+        block = bisect_right(self._ranks, i) - 1
+        i -= self._ranks[block]
+        k = block * self.BLOCK
+        while i >= _BIT_COUNTS[self.data[k]]:
+            i -= _BIT_COUNTS[self.data[k]]
+            k += 1
+        for b in xrange(8):
+            if self.data[k] >> b & 1:
+                if not i:
+                    return 30 * (self.offset + k) + _WHEEL[b]
+                i -= 1
+
+def prime_set(start, end, verbose=False):
+    """
+    Sieves [start, end) straight into a PrimeSet, one segment at a time.
+    >>> list(prime_set(2, 20))
+    [2, 3, 5, 7, 11, 13, 17, 19]
+    >>> list(prime_set(30, 40))
+    [31, 37]
+    >>> len(prime_set(3, 2))
+    0
+    >>> prime_set(0, -1)
+    Traceback (most recent call last):
+    ...
+    ValueError: Start and End values must be positive integers
+    """
+    if start < 0 or end < 0:
+        raise ValueError, "Start and End values must be positive integers"
+    first, last = start // 30, max((end + 29) // 30, start // 30)
+    base_primes = _base_primes(_isqrt(30 * last))
+    # 15 odd candidates per wheel byte
+    step = 2 * (SEGMENT_SIZE // 15 * 15)
+    data = bytearray()
+    for lo in xrange(30 * first + 1, 30 * last + 1, step):
+        hi = min(lo + step, 30 * last + 1)
+        flags = _sieve_segment(lo, hi, base_primes)
+        wheel = bytearray(len(flags) // 15 * 8)
+        for b, r in enumerate(_WHEEL):
+            wheel[b::8] = flags[r // 2::15]
+        data += _pack_bits(wheel)
+    return PrimeSet(start, end, data, [2, 3, 5])
+
+def _percentile(values, pct):
+    """
+    Nearest-rank percentile of values
+    >>> _percentile([3, 1, 2, 4], 50), _percentile(range(1, 101), 95)
+    (2, 95)
+    """
+    values = sorted(values)
+    return values[max(int(ceil(pct / 100.0 * len(values))) - 1, 0)]
+
+def _bench_child(conn, prime_func, start, end, warmup, repeat):
+    #
+    # Runs in a fresh process so ru_maxrss is the peak of this algorithm
+    # alone.  Results are normalized to [start, end) and sorted, since the
+    # classic sieves differ on whether end is included and on ordering.
+    #
+    try:
+        for i in xrange(warmup):
+            prime_func(start, end)
+        times = []
+        for i in xrange(repeat):
+            t = timeit.default_timer()
+            primes = prime_func(start, end)
+            times.append(timeit.default_timer() - t)
+        primes = sorted(p for p in primes if start <= p < end)
+        digest = hashlib.md5(','.join(imap(str, primes))).hexdigest()
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        conn.send((times, rss, len(primes), digest))
+    except Exception, e:
+        conn.send(e)
+    conn.close()
+
+def bench(algorithms, sizes=BENCH_SIZES, start=0, warmup=1, repeat=5,
+        budget=1.0, verbose=False):
+    """
+    Times each (name, desc, prime_func) in algorithms over [start,
+    start + size) for each size, and returns one report row per run.  An
+    algorithm is dropped from the larger sizes once its median time, scaled
+    linearly to the next size, would exceed budget seconds.
+    """
+    rows = []
+    active = list(algorithms)
+    sizes = sorted(sizes)
+    for size, next_size in izip(sizes, sizes[1:] + [0]):
+        end = start + size
+        digests = set()
+        size_rows = []
+        for name, desc, prime_func in list(active):
+            parent, child = multiprocessing.Pipe(False)
+            proc = multiprocessing.Process(target=_bench_child,
+                    args=(child, prime_func, start, end, warmup, repeat))
+            proc.start()
+            result = parent.recv()
+            proc.join()
+            if isinstance(result, Exception):
+                raise result
+            times, rss, count, digest = result
+            digests.add(digest)
+            row = {
+                'algorithm': name,
+                'start': start,
+                'end': end,
+                'size': size,
+                'repeat': repeat,
+                'min': min(times),
+                'median': _percentile(times, 50),
+                'p95': _percentile(times, 95),
+                'peak_rss_kb': rss,
+                'primes': count,
+            }
+            size_rows.append(row)
+            if verbose:
+                print >>sys.stderr, "%s, %d: median %0.6f seconds" % (desc,
+                        size, row['median'])
+            if row['median'] * next_size / size > budget:
+                active.remove((name, desc, prime_func))
+        for row in size_rows:
+            row['agree'] = len(digests) == 1
+        rows.extend(size_rows)
+    return rows
+
+BENCH_FIELDS = ['algorithm', 'start', 'end', 'size', 'repeat', 'min',
+        'median', 'p95', 'peak_rss_kb', 'primes', 'agree']
+
+def run_bench(opts, args):
+    algorithms = [(name, desc, func)
+            for name, (desc, func) in sorted(algorithm_dct.items())]
+    if numpy is not None:
+        for backend, dct in sorted(backend_dct.items()):
+            algorithms.extend(('%s/%s' % (name, backend), desc, func)
+                    for name, (desc, func) in sorted(dct.items()))
+    if opts.bench_algorithms:
+        names = opts.bench_algorithms.lower().split(',')
+        algorithms = [a for a in algorithms if a[0] in names]
+    sizes = [long(n) for n in opts.bench_sizes.split(',')]
+
+    rows = bench(algorithms, sizes, long(opts.start), opts.bench_warmup,
+            opts.bench_repeat, opts.bench_budget, opts.verbose)
+    out = sys.stdout
+    if opts.bench_output:
+        out = open(opts.bench_output, 'wb')
+    if opts.bench_format == 'csv':
+        writer = csv.DictWriter(out, BENCH_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        json.dump(rows, out, indent=2, sort_keys=True)
+        out.write('\n')
+    if out is not sys.stdout:
+        out.close()
+    if not all(row['agree'] for row in rows):
+        print >>sys.stderr, "WARNING: algorithms disagree, see 'agree' column"
+        return 1
+    return 0
+
 def get_primes(opts, args):
     primes = []
 
     start = long(opts.start)
     end = long(opts.end)
 
-    algorithm_dct = {
-        'sundaram': ('Sieve of Sundaram', sieve_of_sundaram),
-        'euler': ('Sieve of Euler', sieve_of_euler),
-        'atkin': ('Sieve of Atkin', sieve_of_atkin),
-        'eratosthenes': ('Sieve of Eratosthenes', sieve_of_eratosthenes),
-        'brute': ('Brute Force', brute_force_primes),
-    }
-    desc, prime_func = algorithm_dct.get(opts.algorithm.lower(),
-            algorithm_dct['atkin'])
+    if opts.cache:
+        print "Finding all primes between %d and %d, using prime cache in %s" \
+                % (start, end, opts.cache_dir)
+        cache = PrimeCache(opts.cache_dir)
+        try:
+            primes.extend(cache.primes(start, end))
+        finally:
+            cache.close()
+        print "Found %d primes" % len(primes)
+        return primes
+
+    desc, prime_func = get_algorithm(opts)
     print "Finding all primes between %d and %d, using %s algorithm..." % (start,
             end, desc)
-    primes.extend(prime_func(start, end, opts.verbose))
+    with timethis(desc):
+        if prime_func is segmented_sieve and opts.compact:
+            primes = prime_set(start, end, opts.verbose)
+        elif prime_func is segmented_sieve:
+            primes.extend(segmented_sieve(start, end, opts.verbose,
+                opts.workers))
+        else:
+            primes.extend(prime_func(start, end, opts.verbose))
+            if opts.compact:
+                # the classic sieves may include end itself
+                primes = PrimeSet.from_primes(primes, start, end + 1)
     print "Found %d primes" % len(primes)
     return primes
 
+def stream_primes(opts, args, out=sys.stdout):
+    """
+    Writes the primes to out one segment at a time as they are found, so
+    a downstream pipe can start consuming immediately.
+
+    A reader that stops early ends the run promptly, workers or not
+    >>> import subprocess
+    >>> subprocess.check_output('timeout 60 "%s" "%s" --stream -s 0 '
+    ...         '-e 100000000 -w 3 2>/dev/null | head -1; '
+    ...         'echo ${PIPESTATUS[0]}' % (sys.executable,
+    ...         __file__.replace('.pyc', '.py')), shell=True,
+    ...         executable='/bin/bash').split()
+    ['2', '0']
+    """
+    start = long(opts.start)
+    end = long(opts.end)
+
+    desc, prime_func = get_algorithm(opts)
+    print >>sys.stderr, "Streaming all primes between %d and %d, " \
+            "using %s algorithm..." % (start, end, desc)
+    pool = None
+    if prime_func is segmented_sieve:
+        if start < 0 or end < 0:
+            raise ValueError, "Start and End values must be positive integers"
+        pool = _sieve_pool(end, opts.workers)
+        chunks = _prime_chunks(start, end, pool)
+    else:
+        # the classic sieves work on the whole range at once, so only the
+        # output is chunked
+        primes = prime_func(start, end, opts.verbose)
+        chunks = (primes[i:i + SEGMENT_SIZE]
+                for i in xrange(0, len(primes), SEGMENT_SIZE))
+    # write straight to the descriptor so that when the reader goes away
+    # the count covers exactly the lines the pipe accepted
+    out.flush()
+    fd = out.fileno()
+    count = 0
+    try:
+        for chunk in chunks:
+            if chunk:
+                data = '\n'.join(imap(str, chunk)) + '\n'
+                while data:
+                    n = os.write(fd, data)
+                    count += data.count('\n', 0, n)
+                    data = data[n:]
+    except OSError, e:
+        # reader went away (eg. piped into head)
+        if e.errno != errno.EPIPE:
+            raise
+    finally:
+        chunks.close()
+        if pool:
+            pool.close()
+    print >>sys.stderr, "Streamed %d primes" % count
+    return count
+
+def _check_callback(option, opt_str, value, parser):
+    """
+    Takes the numbers following --check, negative ones included, which
+    optparse would otherwise read as options.
+    >>> import subprocess
+    >>> subprocess.check_output([sys.executable,
+    ...         __file__.replace('.pyc', '.py'), '--check', '-3', '7']).split()
+    ['-3', 'is', 'not', 'prime', '7', 'is', 'prime']
+    """
+    numbers = []
+    for arg in parser.rargs:
+        try:
+            numbers.append(long(arg))
+        except ValueError:
+            break
+    del parser.rargs[:len(numbers)]
+    parser.values.check = numbers
+
 def main():
-    p = optparse.OptionParser(description=
+    p = optparse.OptionParser(usage="%prog [options] [--check N...]",
+            description=
             'Generate a list of prime numbers using a variety of algorithms',
             version='0.3')
     p.add_option('--start', '-s')
     p.add_option('--end', '-e')
-    p.add_option('--nth', '-n', help='print the nth prime number.')
+    p.add_option('--nth', '-n',
+            help='print the nth prime number (the first prime is 2).')
     p.add_option('--algorithm', '-a',
-            help="algorithms: euler, atkin, eratosthenes, brute")
+            help="algorithms: segmented, sundaram, euler, atkin, "
+                 "eratosthenes, brute")
+    p.add_option('--backend', '-b', choices=['python', 'numpy'],
+            help="backend for the atkin and sundaram sieves: python, numpy")
+    p.add_option('--workers', '-w', type="int",
+            help="sieve segments in N processes (segmented algorithm only)")
+    p.add_option('--check', action="callback", callback=_check_callback,
+            help="test whether each number given as an argument is prime")
+    p.add_option('--count', '-c', action="store_true",
+            help="only print the number of primes between start and end")
+    p.add_option('--stream', action="store_true",
+            help="write primes to stdout as they are found")
+    p.add_option('--compact', action="store_true",
+            help="keep the primes in a wheel bitmap instead of a list")
+    p.add_option('--cache', action="store_true",
+            help="answer from (and grow) the on-disk prime table")
+    p.add_option('--cache-dir', help="prime table directory [%default]")
     p.add_option('--verbose', '-v', action="store_true")
+    g = optparse.OptionGroup(p, "Benchmarking",
+            "Time every algorithm over a ladder of range sizes, starting "
+            "at --start, and report median/p95 time and peak RSS.")
+    g.add_option('--bench', action="store_true")
+    g.add_option('--bench-sizes', help="comma separated range sizes")
+    g.add_option('--bench-algorithms',
+            help="comma separated algorithms, eg. atkin,atkin/numpy")
+    g.add_option('--bench-repeat', type="int", help="timed runs [%default]")
+    g.add_option('--bench-warmup', type="int", help="untimed runs [%default]")
+    g.add_option('--bench-budget', type="float",
+            help="skip the next size once the median, scaled to it, would "
+                 "exceed this many seconds [%default]")
+    g.add_option('--bench-format', choices=['json', 'csv'],
+            help="json, csv [%default]")
+    g.add_option('--bench-output', help="write the report to a file")
+    p.add_option_group(g)
     p.set_defaults(
+         bench_sizes=','.join(map(str, BENCH_SIZES)),
+         bench_repeat=5,
+         bench_warmup=1,
+         bench_budget=1.0,
+         bench_format='json',
          start = 2,
          end = 100,
-         algorithm="atkin",
+         workers = 1,
+         algorithm="segmented",
+         backend="python",
+         cache_dir=CACHE_DIR,
+         check=None,
          nth = 0)
 
     opts, args = p.parse_args()
-    if opts.nth != 0:
-        opts.end = 1000000
+    if opts.bench:
+        sys.exit(run_bench(opts, args))
+
+    if opts.check is not None:
+        try:
+            numbers = opts.check + [long(n) for n in args]
+        except ValueError, e:
+            p.error(str(e))
+        if not numbers:
+            p.error("--check needs one or more numbers")
+        for n, prime in izip(numbers, is_prime_many(numbers)):
+            print "%d is %s" % (n, prime and "prime" or "not prime")
+        return
+
+    if opts.nth:
+        print nth_prime(long(opts.nth))
+        return
+
+    if opts.count:
+        print count_primes(long(opts.start), long(opts.end))
+        return
+
+    if opts.stream:
+        stream_primes(opts, args)
+        return
 
     primes = get_primes(opts, args)
     if opts.verbose:
-        print primes
-    if opts.nth:
-        print primes[int(opts.nth)]
+        print list(primes)
 
 if __name__ == "__main__":
     main()
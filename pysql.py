@@ -1,10 +1,38 @@
 #!/bin/python
 
 import sys
+import binascii
+import cPickle
+import json
+import math
 import optparse
-from datetime import datetime
+import os
+import random
+import resource
+import struct
+import threading
+import time
+import timeit
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from itertools import product
 import pysqlite2.dbapi2 as sqlite3
 
+try:
+	import tracemalloc
+except ImportError:
+	# Python 2 only has it through the pytracemalloc backport
+	tracemalloc = None
+
+try:
+	perf_counter_ns = time.perf_counter_ns
+	CLOCK = "perf_counter_ns"
+except AttributeError:
+	# Python 2 has no monotonic clock, fall back to the best wall clock
+	def perf_counter_ns():
+		return int(timeit.default_timer() * 1e9)
+	CLOCK = "default_timer"
+
 """
    A tool to stress test a SQLite database. Uses 
    the pysqlite3.dbapi2 SQLite inteface.
@@ -12,8 +40,8 @@ import pysqlite2.dbapi2 as sqlite3
 __author__  = "Neil (mace033@gmail.com)"
 __license__ = "GPLv2"
 
-def time_it(desc, func, arg, val_list = None):
-	start = datetime.now()
+def time_it(desc, func, arg, val_list = None, timings = None):
+	start = perf_counter_ns()
 	if val_list:
 		ret = func(arg, val_list)
 	elif arg:
@@ -21,37 +49,133 @@ def time_it(desc, func, arg, val_list = None):
 	else:
 		ret = func()
 
-	print "%s finished in %s" % (desc, datetime.now()-start)
+	elapsed = perf_counter_ns() - start
+	if timings is not None:
+		timings.setdefault(desc, []).append(elapsed)
+
+	print "%s finished in %s" % (desc, ns_delta(elapsed))
 	sys.stdout.flush()
 	return ret
 
-def random_str(min, max):
-	from random import randint, choice
-	'''Returns a random string with min length min and max length'''
-	
-	length = randint(min, max)
-	letters = map(chr, range(97, 123))
-	l = []
-	for i in xrange(length):
-		l.append(choice(letters))
+def ns_delta(ns):
+	return timedelta(microseconds = ns / 1000.0)
+
+# Rows generated per block by RowGenerator
+DATA_BLOCK = 10000
+
+# Maps byte values below 234 (9 * 26) evenly onto the lowercase letters,
+# the rest are rejected and redrawn so every letter is equally likely
+LETTER_TABLE = ''.join(chr(97 + i % 26) for i in xrange(256))
+LETTER_REJECT = ''.join(chr(i) for i in xrange(234, 256))
+
+class RowGenerator:
+	'''Generates user and profile rows a block at a time from one seeded
+	PRNG: each block draws all of its random bytes in a single
+	getrandbits() call and maps them to letters with str.translate.'''
+	def __init__(self, seed = None):
+		self.rng = random.Random(seed)
+
+	def bytes(self, n):
+		if n <= 0:
+			return ''
+		return binascii.unhexlify('%0*x' % (2 * n, self.rng.getrandbits(8 * n)))
+
+	def ints(self, count, min, max):
+		'''Returns count random integers between min and max'''
+		span = max - min + 1
+		return [min + v % span for v in
+			struct.unpack('<%dI' % count, self.bytes(4 * count))]
+
+	def strings(self, count, min, max):
+		'''Returns count random lowercase strings, min to max long'''
+		lengths = self.ints(count, min, max)
+		need = sum(lengths)
+		text = ''
+		while len(text) < need:
+			text += self.bytes((need - len(text)) * 256 / 234 + 16).translate(
+				LETTER_TABLE, LETTER_REJECT)
+		ret = []
+		pos = 0
+		for length in lengths:
+			ret.append(text[pos:pos + length])
+			pos += length
+		return ret
+
+	def users(self, count):
+		'''Returns count (first, middle, last) rows'''
+		return zip(self.strings(count, 7, 11), self.strings(count, 7, 11),
+			self.strings(count, 7, 11))
+
+	def profiles(self, count):
+		'''Returns count (address, city, zip, state) rows'''
+		addresses = ['%d %s' % row for row in
+			zip(self.ints(count, 1, 9999), self.strings(count, 10, 16))]
+		return zip(addresses, self.strings(count, 6, 16),
+			self.ints(count, 10000, 99999), self.strings(count, 2, 2))
+
+class DataFile:
+	'''Replays rows written by write_data_file(), starting over at the end
+	of the file so any number of rows can be drawn.'''
+	def __init__(self, fn):
+		self.fn = fn
+		self.readers = {}
+		# stress writer threads share one DataFile
+		self.lock = threading.Lock()
 
-	return "".join(l)
+	def _blocks(self, kind):
+		while True:
+			f = open(self.fn, 'rb')
+			found = False
+			try:
+				while True:
+					block_kind, rows = cPickle.load(f)
+					if block_kind == kind:
+						found = True
+						yield rows
+			except EOFError:
+				f.close()
+			if not found:
+				raise ValueError, "%s holds no %s rows" % (self.fn, kind)
 
-def random_int(min, max):
-	from random import randint
-	'''Returns a random integer with min value min and max value'''
+	def _rows(self, kind, count):
+		with self.lock:
+			reader = self.readers.setdefault(kind, [self._blocks(kind), []])
+			while len(reader[1]) < count:
+				reader[1].extend(reader[0].next())
+			ret, reader[1] = reader[1][:count], reader[1][count:]
+		return ret
 
-	return randint(min, max)
+	def users(self, count):
+		return self._rows('user', count)
+
+	def profiles(self, count):
+		return self._rows('profile', count)
+
+def write_data_file(fn, rows, seed = None):
+	'''Pre-generates rows users and profiles into fn'''
+	gen = RowGenerator(seed)
+	f = open(fn, 'wb')
+	for first in xrange(0, rows, DATA_BLOCK):
+		count = min(DATA_BLOCK, rows - first)
+		cPickle.dump(('user', gen.users(count)), f, 2)
+		cPickle.dump(('profile', gen.profiles(count)), f, 2)
+	f.close()
+
+# where mk_user_seq() and mk_profile_seq() draw their rows from, set by
+# --seed and --data
+data_source = RowGenerator()
 
 def mk_user_seq():
 	'''A generator that returns randomized first, middle, and last names'''
 	while True:
-		yield (random_str(7, 11), random_str(7, 11), random_str(7, 11))
+		for row in data_source.users(DATA_BLOCK):
+			yield row
 
 def mk_profile_seq():
-	'''A generator that returns randomized first, middle, and last names'''
+	'''A generator that returns randomized addresses, cities, zips and states'''
 	while True:
-		yield (''.join([str(random_int(1, 9999)), ' ', random_str(10, 16)]), random_str(6, 16), random_int(10000, 99999), random_str(2,2))
+		for row in data_source.profiles(DATA_BLOCK):
+			yield row
 
 def get_create_sql():
 	return '''BEGIN;
@@ -70,16 +194,647 @@ def get_create_sql():
 	#		city and state but for column city
 	#		city
 
+def get_query_list():
+	return ["SELECT u.*, p.* FROM user u, profile p WHERE u.id = p.id AND u.first LIKE 'neil%'", 
+		"SELECT u.*, p.* FROM user u, profile p WHERE u.id = p.id AND p.state = 'ca'",
+		"SELECT u.*, p.* FROM user u, profile p WHERE u.id = p.id AND p.zip = 12345"]
+
+USER_SQL = 'INSERT INTO user (first, middle, last) VALUES (:first, :middle, :last)'
+PROFILE_SQL = 'INSERT INTO profile (user_id, address, city, zip, state) VALUES (:user_id, :address, :city, :zip, :state)'
+
+def insert_user(csr, user_gen, profile_gen):
+	'''Inserts one user and its profile, linked through lastrowid'''
+	csr.execute(USER_SQL, user_gen.next())
+	user_id = (csr.lastrowid,)
+	csr.execute(PROFILE_SQL, user_id+profile_gen.next())
+
+def insert_batches(con, inserts, batch_size, verbose = True):
+	'''Bulk loads inserts users and profiles with executemany, batch_size
+	rows per table per transaction.  User ids are assigned up front so the
+	profile rows do not need lastrowid.'''
+	user_sql = 'INSERT INTO user (id, first, middle, last) VALUES (?, ?, ?, ?)'
+	profile_sql = 'INSERT INTO profile (user_id, address, city, zip, state) VALUES (?, ?, ?, ?, ?)'
+	user_gen = mk_user_seq()
+	profile_gen = mk_profile_seq()
+
+	csr = con.cursor()
+	csr.execute('SELECT COALESCE(MAX(id), 0) FROM user')
+	next_id = csr.fetchone()[0] + 1
+
+	total = timedelta()
+	for batch, first in enumerate(xrange(0, inserts, batch_size)):
+		ids = xrange(next_id + first, next_id + min(first + batch_size, inserts))
+		users = [(i,) + user_gen.next() for i in ids]
+		profiles = [(i,) + profile_gen.next() for i in ids]
+
+		start = perf_counter_ns()
+		csr.executemany(user_sql, users)
+		csr.executemany(profile_sql, profiles)
+		con.commit()
+		elapsed = ns_delta(perf_counter_ns() - start)
+		total += elapsed
+
+		if verbose:
+			rows = len(users) + len(profiles)
+			print "batch %d: %d rows in %s (%.0f rows/sec)" % (batch + 1, rows,
+				elapsed, rows / max(elapsed.total_seconds(), 1e-6))
+			sys.stdout.flush()
+	csr.close()
+
+	if verbose:
+		print "%d rows additions finished in %s (%.0f rows/sec)" % (inserts * 2,
+			total, inserts * 2 / max(total.total_seconds(), 1e-6))
+	return total
+
+def percentile(values, pct):
+	'''Nearest-rank percentile of values'''
+	if not values:
+		return 0.0
+	values = sorted(values)
+	return values[max(int(math.ceil(pct / 100.0 * len(values))) - 1, 0)]
+
+def stddev(values):
+	'''Sample standard deviation of values'''
+	if len(values) < 2:
+		return 0.0
+	mean = float(sum(values)) / len(values)
+	return math.sqrt(sum((v - mean) ** 2 for v in values) / (len(values) - 1))
+
+def summarize_timings(timings):
+	'''Reduces the nanosecond samples collected per phase, one per pass,
+	to min, median, p95 and standard deviation'''
+	summary = OrderedDict()
+	for phase, samples in timings.items():
+		summary[phase] = OrderedDict([
+			('passes', len(samples)),
+			('min_ns', min(samples)),
+			('median_ns', percentile(samples, 50)),
+			('p95_ns', percentile(samples, 95)),
+			('stddev_ns', int(round(stddev(samples)))),
+			('samples_ns', samples)])
+	return summary
+
+def print_timings(summary):
+	print "%-24s %6s %12s %12s %12s %12s" % ("phase (ms)", "passes", "min",
+		"median", "p95", "stddev")
+	for phase, s in summary.items():
+		print "%-24s %6d %12.3f %12.3f %12.3f %12.3f" % (phase[:24],
+			s['passes'], s['min_ns'] / 1e6, s['median_ns'] / 1e6,
+			s['p95_ns'] / 1e6, s['stddev_ns'] / 1e6)
+	sys.stdout.flush()
+
+class StressWorker(threading.Thread):
+	'''Runs one role's workload on its own connection until the deadline,
+	recording per-operation latency and SQLITE_BUSY retries.'''
+	def __init__(self, role, db, deadline):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.role = role
+		self.db = db
+		self.deadline = deadline
+		self.latencies = []
+		self.retries = 0
+		self.error = None
+
+	def run(self):
+		# timeout=0 turns off the busy handler, so SQLITE_BUSY reaches us
+		con = sqlite3.connect(self.db, timeout = 0)
+		csr = con.cursor()
+		if self.role == 'writer':
+			user_gen = mk_user_seq()
+			profile_gen = mk_profile_seq()
+			op = lambda: (insert_user(csr, user_gen, profile_gen), con.commit())
+		else:
+			queries = get_query_list()
+			def op():
+				csr.execute(queries[len(self.latencies) % len(queries)])
+				csr.fetchall()
+		try:
+			while time.time() < self.deadline:
+				start = time.time()
+				while True:
+					try:
+						op()
+						break
+					except sqlite3.OperationalError, e:
+						if 'locked' not in str(e) and 'busy' not in str(e):
+							raise
+						self.retries += 1
+						con.rollback()
+						time.sleep(0.001)
+				self.latencies.append(time.time() - start)
+		except Exception, e:
+			self.error = e
+		csr.close()
+		con.close()
+
+def stress(db, readers, writers, duration, journal_mode):
+	'''Runs readers and writers concurrently for duration seconds in
+	journal_mode and prints throughput, latency and busy retries per role.'''
+	con = sqlite3.connect(db)
+	mode = con.execute('PRAGMA journal_mode = %s' % journal_mode).fetchone()[0]
+	con.close()
+
+	deadline = time.time() + duration
+	workers = [StressWorker('reader', db, deadline) for i in xrange(readers)]
+	workers += [StressWorker('writer', db, deadline) for i in xrange(writers)]
+	for w in workers:
+		w.start()
+	for w in workers:
+		w.join()
+
+	print "journal_mode=%s, %d readers, %d writers, %ss" % (mode, readers,
+		writers, duration)
+	print "  %-7s %8s %10s %10s %10s %8s" % ('role', 'ops', 'ops/sec',
+		'p50 ms', 'p99 ms', 'busy')
+	for role in ('reader', 'writer'):
+		role_workers = [w for w in workers if w.role == role]
+		if not role_workers:
+			continue
+		latencies = []
+		for w in role_workers:
+			latencies.extend(w.latencies)
+			if w.error:
+				print "  %s failed: %s" % (role, w.error)
+		print "  %-7s %8d %10.1f %10.3f %10.3f %8d" % (role, len(latencies),
+			len(latencies) / float(duration),
+			percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+			sum(w.retries for w in role_workers))
+	sys.stdout.flush()
+
+DEFAULT_PRAGMA_GRID = ';'.join([
+	'page_size=4096',
+	'journal_mode=delete,wal',
+	'synchronous=off,normal,full',
+	'cache_size=-2000,-65536',
+	'mmap_size=0,268435456',
+	'temp_store=default,memory'])
+
+def parse_pragma_grid(grid):
+	'''Parses "name=a,b;name=c" into [(name, [a, b]), (name, [c])], with
+	page_size first since it only applies before the schema is created.'''
+	ret = []
+	for item in grid.split(';'):
+		if not item.strip():
+			continue
+		name, values = item.split('=', 1)
+		name = name.strip().lower()
+		if not name.replace('_', '').isalnum():
+			raise ValueError, "bad PRAGMA name '%s'" % name
+		ret.append((name, [v.strip() for v in values.split(',')]))
+	ret.sort(key = lambda item: item[0] != 'page_size')
+	return ret
+
+def remove_db(db):
+	for fn in (db, db + '-journal', db + '-wal', db + '-shm'):
+		if os.path.exists(fn):
+			os.remove(fn)
+
+def pragma_matrix(grid, inserts, batch_size, reset_data, db = "pragma_matrix.db"):
+	'''Recreates the schema under every combination of PRAGMA settings in
+	grid, runs the insert and query phases and prints the combinations
+	ranked by insert rows/sec.  reset_data() rewinds data_source before
+	each combination so they all insert the same rows.'''
+	grid = parse_pragma_grid(grid)
+	combos = list(product(*[[(name, v) for v in values] for name, values in grid]))
+	results = []
+	for n, combo in enumerate(combos):
+		reset_data()
+		remove_db(db)
+		con = sqlite3.connect(db)
+		csr = con.cursor()
+		for name, value in combo:
+			csr.execute('PRAGMA %s = %s' % (name, value))
+		csr.executescript(get_create_sql())
+
+		if batch_size:
+			insert_secs = insert_batches(con, inserts, batch_size,
+				verbose = False).total_seconds()
+		else:
+			user_gen = mk_user_seq()
+			profile_gen = mk_profile_seq()
+			start = time.time()
+			for i in xrange(inserts):
+				insert_user(csr, user_gen, profile_gen)
+			con.commit()
+			insert_secs = time.time() - start
+
+		query_secs = []
+		for sql in get_query_list():
+			start = time.time()
+			csr.execute(sql)
+			csr.fetchall()
+			query_secs.append(time.time() - start)
+		csr.close()
+		con.close()
+
+		settings = ' '.join('%s=%s' % (name, value) for name, value in combo)
+		results.append((inserts * 2 / max(insert_secs, 1e-6),
+			sum(query_secs) * 1000, max(query_secs) * 1000, settings))
+		print "[%d/%d] %s: %.0f rows/sec" % (n + 1, len(combos), settings,
+			results[-1][0])
+		sys.stdout.flush()
+	remove_db(db)
+
+	print "\n%4s %12s %10s %10s  %s" % ('rank', 'rows/sec', 'query ms',
+		'worst ms', 'settings')
+	results.sort(key = lambda r: (-r[0], r[1]))
+	for rank, (rate, query_ms, worst_ms, settings) in enumerate(results):
+		print "%4d %12.0f %10.3f %10.3f  %s" % (rank + 1, rate, query_ms,
+			worst_ms, settings)
+	return results
+
+# Indexes the advisor tries one at a time against each query
+CANDIDATE_INDEXES = [
+	('user_first_nocase_idx', 'CREATE INDEX user_first_nocase_idx ON user (first COLLATE NOCASE)'),
+	('profile_state_idx', 'CREATE INDEX profile_state_idx ON profile (state)'),
+	('profile_zip_idx', 'CREATE INDEX profile_zip_idx ON profile (zip)'),
+	('profile_state_cover_idx', 'CREATE INDEX profile_state_cover_idx ON profile (state, id, user_id, address, city, zip)'),
+	('profile_zip_cover_idx', 'CREATE INDEX profile_zip_cover_idx ON profile (zip, id, user_id, address, city, state)'),
+]
+
+def get_query_plan(csr, sql):
+	'''Returns the detail column of EXPLAIN QUERY PLAN for sql'''
+	csr.execute('EXPLAIN QUERY PLAN ' + sql)
+	return [row[-1] for row in csr.fetchall()]
+
+def is_full_scan(detail):
+	'''True for a plan step that walks a whole table rather than an index:
+	"SCAN TABLE user" before SQLite 3.36, "SCAN u" since.'''
+	return detail.startswith('SCAN') and 'INDEX' not in detail
+
+def print_query_plan(csr, sql):
+	for detail in get_query_plan(csr, sql):
+		flag = ''
+		if is_full_scan(detail):
+			flag = '  <-- full table scan'
+		print "  plan: %s%s" % (detail, flag)
+
+def time_query(csr, sql, repeat = 3):
+	'''Returns the best of repeat execute + fetchall times, in seconds'''
+	best = None
+	for i in xrange(repeat):
+		start = time.time()
+		csr.execute(sql)
+		csr.fetchall()
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+def index_advisor(con, queries, candidates = CANDIDATE_INDEXES):
+	'''Times each query without and then with each candidate index and
+	prints the speedup each index gives and whether the planner used it.'''
+	csr = con.cursor()
+	for sql in queries:
+		base = time_query(csr, sql)
+		print "Index advisor for '%s'" % (sql)
+		print "  %-24s %10s %8s  %s" % ('index', 'ms', 'speedup', 'plan')
+		print "  %-24s %10.3f %8s  %s" % ('(none)', base * 1000, '1.00x',
+			'; '.join(get_query_plan(csr, sql)))
+		for name, create_sql in candidates:
+			csr.execute(create_sql)
+			plan = get_query_plan(csr, sql)
+			elapsed = time_query(csr, sql)
+			csr.execute('DROP INDEX %s' % name)
+			used = ''
+			if not [d for d in plan if name in d]:
+				used = ' (unused)'
+			print "  %-24s %10.3f %7.2fx  %s%s" % (name, elapsed * 1000,
+				base / max(elapsed, 1e-9), '; '.join(plan), used)
+		sys.stdout.flush()
+	con.commit()
+	csr.close()
+
+def get_default_workload():
+	'''The built-in user/profile benchmark as a workload spec, the
+	template for --workload files (see --dump-workload)'''
+	return OrderedDict([
+		('schema', get_create_sql()),
+		('tables', [
+			OrderedDict([('name', 'user'), ('rows', 10000), ('columns', OrderedDict([
+				('first', 'str:7:11'), ('middle', 'str:7:11'), ('last', 'str:7:11')]))]),
+			OrderedDict([('name', 'profile'), ('rows', 10000), ('columns', OrderedDict([
+				('user_id', 'ref:user'), ('address', 'str:10:16'), ('city', 'str:6:16'),
+				('zip', 'int:10000:99999'), ('state', 'str:2:2')]))]),
+		]),
+		('queries', [
+			OrderedDict([('name', 'first_like'), ('weight', 1),
+				('sql', "SELECT u.*, p.* FROM user u, profile p WHERE u.id = p.id AND u.first LIKE :first || '%'"),
+				('params', OrderedDict([('first', 'str:2:2')]))]),
+			OrderedDict([('name', 'by_state'), ('weight', 1),
+				('sql', "SELECT u.*, p.* FROM user u, profile p WHERE u.id = p.id AND p.state = :state"),
+				('params', OrderedDict([('state', 'str:2:2')]))]),
+			OrderedDict([('name', 'by_zip'), ('weight', 1),
+				('sql', "SELECT u.*, p.* FROM user u, profile p WHERE u.id = p.id AND p.zip = :zip"),
+				('params', OrderedDict([('zip', 'int:10000:99999')]))]),
+		]),
+	])
+
+def load_workload(fn):
+	'''Reads a workload spec from a JSON file, or a TOML file when the
+	toml package is installed'''
+	f = open(fn)
+	try:
+		if fn.endswith('.toml'):
+			try:
+				import toml
+			except ImportError:
+				raise ValueError, "reading %s needs the toml package" % fn
+			return toml.load(f, _dict = OrderedDict)
+		return json.load(f, object_pairs_hook = OrderedDict)
+	finally:
+		f.close()
+
+def column_values(gen, spec, count, table_rows):
+	'''Returns count values for a column generator spec:
+		str:MIN:MAX   random lowercase string, MIN to MAX long
+		int:MIN:MAX   random integer between MIN and MAX
+		seq           1, 2, 3, ...
+		ref:TABLE     random id of a row in TABLE
+		choice:A|B|C  one of the listed strings'''
+	kind, _, arg = spec.partition(':')
+	if kind == 'str':
+		min, max = map(int, arg.split(':'))
+		return gen.strings(count, min, max)
+	if kind == 'int':
+		min, max = map(int, arg.split(':'))
+		return gen.ints(count, min, max)
+	if kind == 'seq':
+		return range(1, count + 1)
+	if kind == 'ref':
+		return gen.ints(count, 1, table_rows[arg])
+	if kind == 'choice':
+		choices = arg.split('|')
+		return [choices[i] for i in gen.ints(count, 0, len(choices) - 1)]
+	raise ValueError, "unknown column generator '%s'" % spec
+
+def print_histogram(latencies, width = 40):
+	'''Prints a log2 histogram of latencies (seconds) in microseconds'''
+	buckets = {}
+	for t in latencies:
+		b = int(math.log(max(t * 1e6, 1), 2))
+		buckets[b] = buckets.get(b, 0) + 1
+	most = max(buckets.values())
+	for b in xrange(min(buckets), max(buckets) + 1):
+		n = buckets.get(b, 0)
+		print "    < %8dus %-*s %d" % (2 ** (b + 1), width,
+			'#' * int(math.ceil(float(n) / most * width)), n)
+
+def run_workload(db, workload, ops, seed = None, create = True):
+	'''Creates and loads the schema described by workload, then runs ops
+	statements drawn from its weighted query mix with bound parameters
+	and reports throughput and latency per statement.'''
+	gen = RowGenerator(seed)
+	queries = workload['queries']
+	weights = [int(q.get('weight', 1)) for q in queries]
+	if min(weights or [0]) < 0 or sum(weights) <= 0:
+		raise ValueError, "the query weights must not be negative and " \
+			"at least one must be positive"
+	# sqlite3 keeps a prepared statement per distinct SQL string, so bound
+	# parameters let every execution of a query reuse it
+	con = sqlite3.connect(db, cached_statements = max(100, 2 * len(queries)))
+	csr = con.cursor()
+
+	table_rows = {}
+	for table in workload['tables']:
+		table_rows[table['name']] = int(table['rows'])
+	if create:
+		schema = workload['schema']
+		if not isinstance(schema, basestring):
+			schema = ';\n'.join(schema) + ';'
+		time_it("schema creation", csr.executescript, schema)
+		for table in workload['tables']:
+			columns = table['columns'].items()
+			sql = 'INSERT INTO %s (%s) VALUES (%s)' % (table['name'],
+				', '.join(c for c, spec in columns),
+				', '.join('?' for c in columns))
+			start = datetime.now()
+			rows = table_rows[table['name']]
+			for first in xrange(0, rows, DATA_BLOCK):
+				count = min(DATA_BLOCK, rows - first)
+				csr.executemany(sql, zip(*[column_values(gen, spec, count, table_rows)
+					for c, spec in columns]))
+			con.commit()
+			print "%d %s rows loaded in %s" % (rows, table['name'],
+				datetime.now() - start)
+		sys.stdout.flush()
+
+	# pick the statement for every op up front from the weights
+	names = [q.get('name', q['sql']) for q in queries]
+	slots = []
+	for i, w in enumerate(weights):
+		slots.extend([i] * w)
+	mix = [slots[i] for i in gen.ints(ops, 0, len(slots) - 1)]
+
+	params = []
+	for i, q in enumerate(queries):
+		count = mix.count(i)
+		items = q.get('params', {}).items()
+		values = [column_values(gen, spec, count, table_rows) for name, spec in items]
+		params.append([dict(zip([name for name, spec in items], row))
+			for row in zip(*values)] if items else [{}] * count)
+
+	latencies = [[] for q in queries]
+	rows = [0] * len(queries)
+	wall = time.time()
+	for i in mix:
+		start = time.time()
+		csr.execute(queries[i]['sql'], params[i][len(latencies[i])])
+		rows[i] += len(csr.fetchall())
+		latencies[i].append(time.time() - start)
+	wall = time.time() - wall
+	csr.close()
+	con.close()
+
+	print "%d statements in %0.3fs (%0.1f/sec)" % (ops, wall, ops / max(wall, 1e-9))
+	for i, name in enumerate(names):
+		l = latencies[i]
+		if not l:
+			continue
+		print "%s: %d runs, %0.1f/sec, %d rows, p50 %0.3fms, p99 %0.3fms" % (name,
+			len(l), len(l) / max(wall, 1e-9), rows[i],
+			percentile(l, 50) * 1000, percentile(l, 99) * 1000)
+		print_histogram(l)
+	sys.stdout.flush()
+
+def get_rss_kb(fd):
+	'''Current resident set size of this process in KB, from fd open on
+	/proc/self/statm'''
+	os.lseek(fd, 0, os.SEEK_SET)
+	return int(os.read(fd, 256).split()[1]) * resource.getpagesize() / 1024
+
+class RssProbe:
+	'''Tracks the peak RSS over a baseline while keeping its own cost
+	out of the timings: probe_ns is the time spent in sample()'''
+	def __init__(self):
+		self.fd = os.open('/proc/self/statm', os.O_RDONLY)
+		self.base = self.peak = get_rss_kb(self.fd)
+		self.probe_ns = 0
+
+	def sample(self):
+		start = perf_counter_ns()
+		self.peak = max(self.peak, get_rss_kb(self.fd))
+		self.probe_ns += perf_counter_ns() - start
+
+	def close(self):
+		os.close(self.fd)
+		return self.peak - self.base
+
+def fetch_query(csr, sql, mode = 'all', arraysize = 256):
+	'''Runs sql and drains the result with fetchall, fetchmany or by
+	iterating the cursor.  Returns (rows, seconds to the first row, total
+	seconds, peak memory in KB): the traced Python heap peak when
+	tracemalloc is available, otherwise the most the process RSS grew
+	over its size before the query, sampled after every fetch.  The
+	time spent sampling RSS is left out of the total.'''
+	probe = None
+	if tracemalloc:
+		tracemalloc.start()
+	else:
+		probe = RssProbe()
+	csr.arraysize = arraysize
+	first = None
+	count = 0
+	start = perf_counter_ns()
+	csr.execute(sql)
+	if mode == 'all':
+		rows = csr.fetchall()
+		first = perf_counter_ns()
+		count = len(rows)
+		if probe:
+			probe.sample()
+		del rows
+	elif mode == 'many':
+		while True:
+			rows = csr.fetchmany()
+			if first is None:
+				first = perf_counter_ns()
+			if probe:
+				probe.sample()
+			if not rows:
+				break
+			count += len(rows)
+	else:
+		for row in csr:
+			if first is None:
+				first = perf_counter_ns()
+			count += 1
+			if probe and count % arraysize == 0:
+				probe.sample()
+		if first is None:
+			first = perf_counter_ns()
+		if probe:
+			probe.sample()
+	end = perf_counter_ns()
+	if tracemalloc:
+		peak = tracemalloc.get_traced_memory()[1] / 1024
+		tracemalloc.stop()
+	else:
+		end -= probe.probe_ns
+		peak = probe.close()
+	return count, (first - start) / 1e9, (end - start) / 1e9, peak
+
 def main():
 	p = optparse.OptionParser(description='SQLite stress tester.', version='0.1')
 	p.add_option('--create', '-c', action = "store_true")	
 	p.add_option('--query', '-q', action = "store_true")
-	p.add_option('--indexes', '-x', action = "store_true")
+	p.add_option('--fetch-mode', '-f', choices = ['all', 'many', 'iter'],
+		default = 'all', help = "fetchall, fetchmany or iterate the cursor [%default]")
+	p.add_option('--arraysize', '-a', type = "int", default = 256,
+		help = "rows per fetchmany call [%default]")
+	p.add_option('--indexes', '-x', action = "store_true",
+		help = "time the queries with and without each candidate index")
 	p.add_option('--inserts', '-i')
-	p.add_option('--passes', '-p', default = "1")
+	p.add_option('--batch-size', '-b', type = "int",
+		help = "bulk load the inserts with executemany, N rows per transaction")
+	p.add_option('--passes', '-p', default = "1",
+		help = "repeat the schema, insert, commit and query phases N times "
+		"and report min/median/p95/stddev per phase [%default]")
+	p.add_option('--json', metavar = "FILE",
+		help = "write the per-phase timings as JSON to FILE (- for stdout)")
+	p.add_option('--seed', '-s', type = "int",
+		help = "seed the generated rows so runs are reproducible")
+	p.add_option('--gen-data', metavar = "FILE",
+		help = "pre-generate the --inserts rows into FILE and exit")
+	p.add_option('--data', metavar = "FILE",
+		help = "insert rows pre-generated with --gen-data")
+	g = optparse.OptionGroup(p, "Concurrency",
+		"Run the query workload and the insert workload concurrently, each "
+		"reader and writer in its own thread with its own connection.")
+	g.add_option('--readers', '-r', type = "int", default = 0)
+	g.add_option('--writers', '-w', type = "int", default = 0)
+	g.add_option('--duration', '-d', type = "float", default = 10.0,
+		help = "seconds per journal mode [%default]")
+	g.add_option('--journal-modes', default = "delete,wal",
+		help = "journal modes to compare [%default]")
+	p.add_option_group(g)
+	g = optparse.OptionGroup(p, "PRAGMA tuning",
+		"Run the insert and query phases on a fresh database for every "
+		"combination of PRAGMA settings and rank the results.  The grid is "
+		"written name=value,value;name=value,...")
+	g.add_option('--pragma-matrix', '-m', action = "store_true")
+	g.add_option('--pragmas', default = DEFAULT_PRAGMA_GRID,
+		help = "[%default]")
+	p.add_option_group(g)
+	g = optparse.OptionGroup(p, "Workloads",
+		"Load a schema, row generators and a weighted query mix from a JSON "
+		"(or TOML) spec instead of the built-in tables and queries.")
+	g.add_option('--workload', metavar = "FILE")
+	g.add_option('--ops', type = "int", default = 10000,
+		help = "statements to run from the query mix [%default]")
+	g.add_option('--reuse', action = "store_true",
+		help = "run the query mix against the tables a previous --workload "
+		"run loaded instead of creating them again")
+	g.add_option('--dump-workload', action = "store_true",
+		help = "print the built-in workload as a JSON spec and exit")
+	p.add_option_group(g)
 	opts, args = p.parse_args()
 
-	if opts.create is None and opts.query is None and opts.inserts is None: 
+	if opts.dump_workload:
+		print json.dumps(get_default_workload(), indent = 2)
+		return
+
+	json_out = None
+	if opts.json == '-':
+		# stdout carries only the JSON, the report goes to stderr
+		json_out = sys.stdout
+		sys.stdout = sys.stderr
+
+	if opts.gen_data:
+		write_data_file(opts.gen_data, int(opts.inserts or 10000), opts.seed)
+		return
+	# every pass inserts the same rows, from the start of the data file
+	# or from a generator seeded once per run
+	seed = opts.seed
+	if seed is None:
+		seed = random.getrandbits(32)
+	def reset_data_source():
+		global data_source
+		if opts.data:
+			data_source = DataFile(opts.data)
+		else:
+			data_source = RowGenerator(seed)
+	reset_data_source()
+
+	if opts.workload:
+		try:
+			run_workload("test.db", load_workload(opts.workload), opts.ops,
+				opts.seed, not opts.reuse)
+		except (ValueError, KeyError), e:
+			p.error("bad workload %s: %s" % (opts.workload, e))
+		return
+
+	if opts.pragma_matrix:
+		try:
+			pragma_matrix(opts.pragmas, int(opts.inserts or 10000),
+				opts.batch_size, reset_data_source)
+		except ValueError, e:
+			p.error(str(e))
+		return
+
+	if opts.create is None and opts.query is None and opts.inserts is None \
+			and not (opts.readers or opts.writers):
 		p.print_help()
 		sys.exit(2)
 
@@ -93,35 +848,85 @@ def main():
 	if opts.create:
 		schema  = get_create_sql()
 
+	passes = int(opts.passes)
+	queries = query and get_query_list() or []
+	timings = OrderedDict()
+
 	con = sqlite3.connect("test.db")
 	csr = con.cursor()
 
-	if schema:
-		time_it("schema creation", csr.executescript, schema)
+	for n in xrange(passes):
+		if passes > 1:
+			print "pass %d of %d" % (n + 1, passes)
+			reset_data_source()
+
+		if schema:
+			time_it("schema creation", csr.executescript, schema,
+				timings = timings)
+
+		if inserts and opts.batch_size:
+			total = insert_batches(con, inserts, opts.batch_size)
+			timings.setdefault("inserts", []).append(
+				int(total.total_seconds() * 1e9))
+		elif inserts:
+			user_gen = mk_user_seq()
+			profile_gen = mk_profile_seq()
+			start = perf_counter_ns()
+			for i in xrange(inserts):
+				insert_user(csr, user_gen, profile_gen)
+			elapsed = perf_counter_ns() - start
+			timings.setdefault("inserts", []).append(elapsed)
+			print "%d rows additions finished in %s" % (inserts * 2, ns_delta(elapsed))
+
+			time_it("transaction commit", con.commit, None, timings = timings)
 
-	if inserts:
-		user_sql = 'INSERT INTO user (first, middle, last) VALUES (:first, :middle, :last)'
-		user_gen = mk_user_seq()
-		profile_sql = 'INSERT INTO profile (user_id, address, city, zip, state) VALUES (:user_id, :address, :city, :zip, :state)'
-		profile_gen = mk_profile_seq()
-		start = datetime.now()
-		for i in xrange(inserts):
-			csr.execute(user_sql, user_gen.next())
-			user_id = (csr.lastrowid,)
-			csr.execute(profile_sql, user_id+profile_gen.next())
-		print "%d rows additions finished in %s" % (inserts * 2, datetime.now()-start)
-		
-		ret = time_it("transaction commit", con.commit, None)
-
-	if query:
-		query_list = ["SELECT u.*, p.* FROM user u, profile p WHERE u.id = p.id AND u.first LIKE 'neil%'", 
-			"SELECT u.*, p.* FROM user u, profile p WHERE u.id = p.id AND p.state = 'ca'",
-			"SELECT u.*, p.* FROM user u, profile p WHERE u.id = p.id AND p.zip = 12345"]
-		for sql in query_list:
+		for i, sql in enumerate(queries):
 			print "Runing query '%s'" % (sql)
-			csr.execute(sql)
-			ret = time_it("query", csr.fetchall, None)
-			print "%d rows found" % (len(ret))
+			if n == 0:
+				print_query_plan(csr, sql)
+			rows, first, total, peak = fetch_query(csr, sql, opts.fetch_mode,
+				opts.arraysize)
+			timings.setdefault("query %d" % (i + 1), []).append(int(total * 1e9))
+			print "query finished in %s, first row after %s, peak memory %s %dKB" % (
+				timedelta(seconds = total), timedelta(seconds = first),
+				tracemalloc and "(traced)" or "(rss growth)", peak)
+			print "%d rows found" % (rows)
+			sys.stdout.flush()
+
+	summary = summarize_timings(timings)
+	if passes > 1 and summary:
+		print_timings(summary)
+
+	if opts.json:
+		report = OrderedDict([
+			('clock', CLOCK),
+			('sqlite_version', sqlite3.sqlite_version),
+			('passes', passes),
+			('inserts', inserts),
+			('batch_size', opts.batch_size),
+			('fetch_mode', opts.fetch_mode),
+			('queries', queries),
+			('phases', summary)])
+		if json_out:
+			json.dump(report, json_out, indent = 2)
+			json_out.write('\n')
+			json_out.flush()
+		else:
+			with open(opts.json, 'w') as f:
+				json.dump(report, f, indent = 2)
+
+	if opts.readers or opts.writers:
+		# journal_mode is stored in the database file, put it back so
+		# later runs do not silently benchmark the last stressed mode
+		original = con.execute('PRAGMA journal_mode').fetchone()[0]
+		for mode in opts.journal_modes.split(','):
+			stress("test.db", opts.readers, opts.writers, opts.duration, mode)
+		restore = sqlite3.connect("test.db")
+		restore.execute('PRAGMA journal_mode = %s' % original)
+		restore.close()
+
+	if queries and opts.indexes:
+		index_advisor(con, queries)
 
 	csr.close()
 	con.close()